@@ -0,0 +1,244 @@
+import contextlib
+import hashlib
+import os
+import socket
+import threading
+import time
+import uuid
+
+from CibusLogging import logger
+
+default_lease_ttl = 60  # seconds, a lease that isn't renewed in time is taken over by other workers
+
+
+def get_account_key(user_name):
+    """
+    Converts a Cibus user name into a lease account key, so the lease store doesn't hold user names.
+
+    Args:
+        user_name (str): The username of the user.
+
+    Returns:
+        str: The account key.
+    """
+    return hashlib.sha256(user_name.encode('utf-8')).hexdigest()
+
+
+def create_lease_owner():
+    """
+    Creates a unique lease owner identifier for this worker.
+
+    Returns:
+        str: The lease owner identifier, a UUID, as required by blob leases.
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4()}'))
+
+
+class SqliteLeaseStore:
+    """
+    A lease store in a local SQLite database, shared by the workers of a single machine (and by tests).
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): The SQLite database file.
+        """
+        self.path = path
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS leases '
+                               '(account TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)')
+
+    def _connect(self):
+        import sqlite3
+        return contextlib.closing(sqlite3.connect(self.path, timeout=30, isolation_level=None))
+
+    def try_acquire(self, account, owner, ttl):
+        """
+        Acquires the account lease, unless another owner holds an unexpired lease on it.
+
+        Args:
+            account (str): The account key.
+            owner (str): The lease owner identifier.
+            ttl (float): The lease time to live, in seconds.
+
+        Returns:
+            bool: True if the lease is acquired, False otherwise.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'INSERT INTO leases (account, owner, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (account) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                'WHERE leases.expires_at <= ? OR leases.owner = excluded.owner',
+                (account, owner, now + ttl, now))
+            return cursor.rowcount == 1
+
+    def renew(self, account, owner, ttl):
+        """
+        Extends the account lease held by the owner.
+
+        Args:
+            account (str): The account key.
+            owner (str): The lease owner identifier.
+            ttl (float): The lease time to live from now, in seconds.
+
+        Returns:
+            bool: True if the lease is renewed, False if the owner doesn't hold it anymore.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'UPDATE leases SET expires_at = ? WHERE account = ? AND owner = ? AND expires_at > ?',
+                (now + ttl, account, owner, now))
+            return cursor.rowcount == 1
+
+    def release(self, account, owner):
+        """
+        Releases the account lease, if the owner holds it.
+
+        Args:
+            account (str): The account key.
+            owner (str): The lease owner identifier.
+        """
+        with self._connect() as connection:
+            connection.execute('DELETE FROM leases WHERE account = ? AND owner = ?', (account, owner))
+
+
+class BlobLeaseStore:
+    """
+    A lease store over Azure blob leases, shared by all the Function App instances. Every account has an empty
+    blob in the container, and its blob lease is the account lease. Blob leases last 15 to 60 seconds, so the
+    lease TTL is clamped into that range.
+    """
+
+    def __init__(self, connection_string, container_name='cibus-account-leases'):
+        """
+        Args:
+            connection_string (str): The storage account connection string, e.g. the AzureWebJobsStorage setting.
+            container_name (str): The container of the account lease blobs, created if missing.
+        """
+        from azure.core.exceptions import ResourceExistsError
+        from azure.storage.blob import BlobServiceClient
+
+        self.container = BlobServiceClient.from_connection_string(connection_string).get_container_client(
+            container_name)
+        try:
+            self.container.create_container()
+        except ResourceExistsError:
+            pass
+
+    @staticmethod
+    def _lease_duration(ttl):
+        return min(max(int(ttl), 15), 60)
+
+    def _blob(self, account):
+        return self.container.get_blob_client(account)
+
+    def try_acquire(self, account, owner, ttl):
+        from azure.core.exceptions import HttpResponseError, ResourceExistsError
+
+        blob = self._blob(account)
+        try:
+            blob.upload_blob(b'', overwrite=False)
+        except ResourceExistsError:
+            pass
+
+        try:
+            blob.acquire_lease(lease_duration=self._lease_duration(ttl), lease_id=owner)
+        except HttpResponseError as error:
+            if error.status_code == 409:  # the blob is leased by another owner
+                return False
+            raise
+        return True
+
+    def renew(self, account, owner, ttl):
+        from azure.core.exceptions import HttpResponseError
+        from azure.storage.blob import BlobLeaseClient
+
+        try:
+            BlobLeaseClient(self._blob(account), lease_id=owner).renew()
+        except HttpResponseError as error:
+            if error.status_code == 409:  # the lease expired and was taken by another owner
+                return False
+            raise
+        return True
+
+    def release(self, account, owner):
+        from azure.core.exceptions import HttpResponseError
+        from azure.storage.blob import BlobLeaseClient
+
+        try:
+            BlobLeaseClient(self._blob(account), lease_id=owner).release()
+        except HttpResponseError as error:
+            if error.status_code != 409:
+                raise
+
+
+class AccountLease:
+    """
+    A held account lease, renewed in the background every third of its TTL until released.
+    """
+
+    def __init__(self, store, account, owner, ttl):
+        self.store = store
+        self.account = account
+        self.owner = owner
+        self.ttl = ttl
+        self.lost = False
+        self._released = threading.Event()
+        self._renewal_thread = threading.Thread(target=self._renew_until_released, daemon=True)
+
+    def _renew_until_released(self):
+        while not self._released.wait(self.ttl / 3):
+            try:
+                is_renewed = self.store.renew(self.account, self.owner, self.ttl)
+            except Exception:
+                logger.exception('account lease - renewal error, account: %s', self.account)
+                continue
+
+            if not is_renewed:
+                self.lost = True
+                logger.error('account lease - lost, account: %s', self.account)
+                return
+
+    def start_renewal(self):
+        self._renewal_thread.start()
+
+    def release(self):
+        self._released.set()
+        if self._renewal_thread.is_alive():
+            self._renewal_thread.join()
+        if not self.lost:
+            self.store.release(self.account, self.owner)
+
+
+@contextlib.contextmanager
+def account_lease(store, user_name, ttl=default_lease_ttl, owner=None):
+    """
+    Holds the user's account lease for the duration of the context, so only one worker processes the account
+    at a time.
+
+    Args:
+        store: The lease store, e.g. SqliteLeaseStore or BlobLeaseStore.
+        user_name (str): The username of the user.
+        ttl (float): The lease time to live, in seconds.
+        owner (str): The lease owner identifier, a new one by default.
+
+    Yields:
+        AccountLease: The held lease, or None if another worker holds it.
+    """
+    account = get_account_key(user_name)
+    owner = owner or create_lease_owner()
+
+    if not store.try_acquire(account, owner, ttl):
+        logger.info('account lease - held by another worker, account: %s', account)
+        yield None
+        return
+
+    lease = AccountLease(store, account, owner, ttl)
+    lease.start_renewal()
+    try:
+        yield lease
+    finally:
+        lease.release()
@@ -1,458 +1,151 @@
-import logging
-from datetime import datetime
-import http.client
-import json
-import sys
+import functools
+import os
 import azure.functions as func
 
-test_mode = False
-
-cibus_auth_url = 'api.capir.pluxee.co.il'
-cibus_auth_authority_header = 'capir.mysodexo.co.il'
-
-cibus_url = 'api.consumers.pluxee.co.il'
-cibus_authority_header = 'api.mysodexo.co.il'
-cibus_accept_header = 'application/json, text/plain, */*'
-cibus_accept_language_header = 'he'
-cibus_application_id_header = 'E5D5FEF5-A05E-4C64-AEBA-BA0CECA0E402'
-cibus_content_type_header = 'application/json; charset=UTF-8'
-cibus_cache_control = 'no-cache'
-
-comp_id = 2199
-restaurant_id = 37829
-order_type = 2
-address_id = 1000849267
-category_id = 4755799
+# The purchase engine (CibusPurchaseEngine.py) is imported by the triggers on first use, so indexing the functions
+# on a cold start only loads this module.
 
-
-def is_valid_time():
-    # Get the current date and time
-    current_time = datetime.now()
-    logging.info(f'is_valid_time - Current Time: {current_time}')
-
-    # Check if the current day is not Friday or Saturday
-    if current_time.weekday() not in [4, 5]:
-        # Check if the current time is between 8pm and 9pm
-        if 20 <= current_time.hour < 21:
-            logging.info('is_valid_time - valid time')
-            return True
-    logging.info('is_valid_time - Doesn\'t valid time')
-    return False
+test_mode = False
 
 
-def convert_json_to_string(json_object):
+@functools.cache
+def get_account_settings():
     """
-    Converts a JSON object into a JSON string.
-
-    Args:
-        json_object (dict): A dictionary representing a JSON object.
+    Loads the Cibus account settings from the app settings, on the first trigger.
 
     Returns:
-        str: A JSON string representation of the input JSON object.
-    """
-    return json.dumps(json_object)
-
+        tuple: The Cibus user name (str), password (str) and solver policy (str) - a policy name, or a JSON spec such
+            as {"objective": "within_budget", "max_coupons": 3, "penalties": {"50": 1}}, see
+            CibusPurchaseEngine.build_solver_policy.
 
-def get_best_combination(coupon_values_array, target_value, i):
+    Raises:
+        ValueError: If the solver policy is invalid.
     """
-    Calculates the best combination of coupon values that cover the target value,
-    taking into account the minimum difference between the total coupons value and the target value,
-    and selecting the minimum coupon value for the minimum difference.
+    import CibusPurchaseEngine
 
-    Args:
-        coupon_values_array (list): A list of coupon values.
-        target_value (int): The target value to be covered by the coupon combination.
-        i (int): index at the array - for recursion.
+    user_name = os.environ.get('CIBUS_USER_NAME', '')  # set Cibus user name
+    password = os.environ.get('CIBUS_PASSWORD', '')  # set Cibus user's password
+    solver_policy = os.environ.get('CIBUS_SOLVER_POLICY', CibusPurchaseEngine.default_solver_policy)  # set Cibus user's solver policy
+    CibusPurchaseEngine.get_solver_policy(solver_policy)
 
-    Returns:
-        list: The best combination of coupons that covers the target value.
-    """
-    if target_value <= 0:
-        return [0] * len(coupon_values_array), 0
-    elif i < 0:
-        return [0] * len(coupon_values_array), sys.maxsize
-
-    # or don't take
-    coupon_count_dont_take, coupon_value_dont_take = get_best_combination(coupon_values_array, target_value, i - 1)
-
-    # or took
-    coupon_count_take, coupon_value_take = get_best_combination(coupon_values_array, target_value - coupon_values_array[i], i)
-    coupon_value_take = coupon_value_take + coupon_values_array[i]
-    coupon_count_take[i] += 1
-
-    if coupon_value_dont_take == coupon_value_take:
-        dont_take_coupon_count = sum(coupon_count_dont_take)
-        take_coupon_count = sum(coupon_count_take)
-        if dont_take_coupon_count < take_coupon_count:
-            return coupon_count_dont_take, coupon_value_dont_take
-        else:
-            return coupon_count_take, coupon_value_take
-    elif coupon_value_dont_take < coupon_value_take:
-        return coupon_count_dont_take, coupon_value_dont_take
-    else:
-        return coupon_count_take, coupon_value_take
+    return user_name, password, solver_policy
 
 
-def get_user_token(user_name, password, company):
+@functools.cache
+def get_accounts_roster():
     """
-    Retrieves a user authentication token for the provided user credentials.
-
-    Args:
-        user_name (str): The username of the user.
-        password (str): The password of the user.
-        company (str): The company associated with the user.
+    Loads the roster of Cibus accounts from the CIBUS_ACCOUNTS app setting, on the first trigger - a JSON list of
+    {"user_name", "password", "solver_policy"} objects, where the solver policy is a policy name or a spec object,
+    see CibusPurchaseEngine.build_solver_policy. Without it, the roster is the single account settings.
 
     Returns:
-        str: A user authentication token if the authentication is successful.
-    """
-    logging.info('get_user_token - start')
-
-    conn = http.client.HTTPSConnection(cibus_auth_url)
-
-    headers = {
-        'authority': cibus_auth_authority_header,
-        'accept': cibus_accept_header,
-        'accept-language': cibus_accept_language_header,
-        'application-id': cibus_application_id_header,
-        'content-type': cibus_content_type_header
-    }
-
-    payload = {
-        "username": user_name,
-        "password": password,
-        "company": company
-    }
-    payload = convert_json_to_string(payload)
-
-    conn.request('POST', '/auth/authToken', payload, headers)
-    res = conn.getresponse()
-
-    data = json.loads(res.read().decode('utf-8'))
-    token = data['data']['token']
-
-    logging.info('get_user_token - end')
-    return token
-
-
-def get_user_data(token):
-    """
-    Retrieves user data including user ID and budget using an authentication token.
-
-    Args:
-        token (str): A user authentication token obtained through login.
+        list: The accounts, as (user name, password, solver policy) tuples.
 
-    Returns:
-        tuple: A tuple containing user ID (str) and user budget (float).
+    Raises:
+        ValueError: If a solver policy is invalid.
     """
-    logging.info('get_user_data - start')
-
-    conn = http.client.HTTPSConnection(cibus_url)
-
-    headers = {
-        'authority': cibus_authority_header,
-        'accept': cibus_accept_header,
-        'accept-language': cibus_accept_language_header,
-        'application-id': cibus_application_id_header,
-        'content-type': cibus_content_type_header,
-        'cookie': f'token={token}'
-    }
-
-    payload = ''
+    import json
+    import CibusPurchaseEngine
 
-    conn.request('GET', '/api/prx_user_info.py', payload, headers)
-    res = conn.getresponse()
+    accounts = os.environ.get('CIBUS_ACCOUNTS')
+    if not accounts:
+        return [get_account_settings()]
 
-    data = json.loads(res.read().decode('utf-8'))
-    user_id = data['user_cibus_id']
-    user_budget = float(data['budget'])
-    logging.info('get_user_data - end')
+    accounts = [(account['user_name'], account['password'],
+                 account.get('solver_policy', CibusPurchaseEngine.default_solver_policy))
+                for account in json.loads(accounts)]
+    for _, _, solver_policy in accounts:
+        CibusPurchaseEngine.get_solver_policy(solver_policy)
+    return accounts
 
-    return user_id, user_budget
 
-
-def get_available_coupons(token):
+@functools.cache
+def get_pipeline_settings():
     """
-    Retrieves available coupons for the user using an authentication token.
-
-    Args:
-        token (str): A user authentication token obtained through login.
+    Loads the roster pipeline settings from the app settings, on the first trigger - CIBUS_PIPELINE_STAGES, a JSON
+    object of the [workers, queue size] of the stages to override (e.g. {"cart": [16, 32]}, see
+    CibusPipeline.default_stage_settings), and CIBUS_SOLVE_PROCESSES, the number of solver processes (0 to solve in
+    threads).
 
     Returns:
-        dict: A dictionary containing coupon prices (int) as keys and their respective element IDs (int) as values.
+        tuple: The stage settings (dict, or None for the defaults) and the number of solver processes (int).
     """
-    logging.info('get_available_coupons - start')
-
-    conn = http.client.HTTPSConnection(cibus_url)
-
-    headers = {
-        'authority': cibus_authority_header,
-        'accept': 'application json, text plain, */*',
-        'accept-language': cibus_accept_language_header,
-        'application-id': cibus_application_id_header,
-        'content-type': cibus_content_type_header,
-        'cookie': f'token={token}'
-    }
-
-    payload = ''
-
-    url = f'/api/rest_menu_tree.py?restaurant_id={restaurant_id}&comp_id={comp_id}&order_type={order_type}&element_type_deep=16&lang=he&address_id={address_id}'
-
-    conn.request('GET', url, payload, headers)
-    res = conn.getresponse()
-
-    data = json.loads(res.read().decode('utf-8'))
-
-    coupons_response = data['12'][0]['13']
-    coupons = {item['price']: item['element_id'] for item in coupons_response}
+    import json
 
-    logging.info('get_available_coupons - end')
+    stage_settings = os.environ.get('CIBUS_PIPELINE_STAGES')
+    stage_settings = {name: tuple(settings) for name, settings in json.loads(stage_settings).items()} \
+        if stage_settings else None
+    solve_process_workers = int(os.environ.get('CIBUS_SOLVE_PROCESSES', 0))
 
-    return coupons
+    return stage_settings, solve_process_workers
 
 
-def get_order_time(token):
+@functools.cache
+def setup_logging():
     """
-    Inserts a coupon item with specific dish ID and price into the user's shopping cart.
-
-    Args:
-        token (str): A user authentication token obtained through login.
-        dish_id (int): The unique dish ID of the coupon item to be added to the cart.
-        dish_price (float): The price of the coupon item.
-
-    Returns:
-        bool: True if the coupon item is successfully inserted into the cart, False otherwise.
+    Moves the purchase flow logging off the invocation thread, on the first trigger - see
+    CibusLogging.enable_queue_logging.
     """
-    logging.info(f'get_order_time - start')
-
-    conn = http.client.HTTPSConnection(cibus_url)
-    payload = ''
-    headers = {
-        'accept': cibus_accept_header,
-        'accept-language': cibus_accept_language_header,
-        'application-id': cibus_application_id_header,
-        'cache-control': cibus_cache_control,
-        'content-type': cibus_content_type_header,
-        'cookie': f'token={token}'
-    }
-    conn.request('GET', f'/api/prx_order_times.py?order_type={order_type}&rest_id={restaurant_id}', payload, headers)
-    res = conn.getresponse()
-
-    if not(200 <= res.status <= 299):
-        logging.error(f'get_order_time, response: {res.status}')
-        logging.error('get_order_time - failed')
-        return False
-
-    data = json.loads(res.read().decode('utf-8'))
-    order_time = data['timeinfo']['ordtime'][0]['time']
-
-    logging.info(f'get_order_time - end')
-    return order_time
-
-
-def insert_coupon_to_cart(token, dish_id, dish_price):
-    """
-    Inserts a coupon item with specific dish ID and price into the user's shopping cart.
+    import CibusLogging
+    CibusLogging.enable_queue_logging()
 
-    Args:
-        token (str): A user authentication token obtained through login.
-        dish_id (int): The unique dish ID of the coupon item to be added to the cart.
-        dish_price (float): The price of the coupon item.
 
-    Returns:
-        bool: True if the coupon item is successfully inserted into the cart, False otherwise.
+@functools.cache
+def get_lease_store():
     """
-    logging.info(f'insert_coupon_to_cart of value: {dish_price} - start')
-
-    conn = http.client.HTTPSConnection(cibus_url)
-
-    headers = {
-        'authority': cibus_authority_header,
-        'accept': cibus_accept_header,
-        'accept-language': cibus_accept_language_header,
-        'application-id': cibus_application_id_header,
-        'content-type': cibus_content_type_header,
-        'cookie': f'token={token}'
-    }
-
-    payload = {
-        'type': 'prx_add_prod_to_cart',
-        'order_type': order_type,
-        'dish_list': {
-            'category_id': category_id,
-            'dish_id': dish_id,
-            'dish_price': dish_price,
-            'co_owner_id': -1,
-            'extra_list': []
-        }
-    }
-    payload = convert_json_to_string(payload)
-
-    conn.request('POST', '/api/main.py', payload, headers)
-    res = conn.getresponse()
-
-    if not(200 <= res.status <= 299):
-        logging.error(f'insert_coupon_to_cart, response: {res.status}')
-        logging.error('insert_coupon_to_cart - failed')
-        return False
-
-    data = json.loads(res.read().decode('utf-8'))
-
-    if data['code'] != 0:
-        logging.error(f'insert_coupon_to_cart, response: {data["msg"]}')
-        logging.error('insert_coupon_to_cart - failed')
-        return False
-
-    logging.info(f'insert_coupon_to_cart of value: {dish_price} - end')
-
-    return True
-
-
-def validate_coupon_inserted_to_cart(token, order_time):
-    """
-    Validates whether a coupon is successfully inserted into the user's cart for a simulated order.
-
-    Args:
-        token (str): A user authentication token obtained through login.
-        order_time (str): The desired order time, formatted as "HH:mm".
+    Creates the account lease store over the Function App storage account, on the first trigger, so scaled-out
+    instances and overlapping timer firings don't process the same account at once.
 
     Returns:
-        bool: True if the coupon is successfully inserted into the cart for the simulated order, False otherwise.
+        CibusAccountLease.BlobLeaseStore: The lease store, or None if no storage account is configured or the
+            azure-storage-blob package isn't installed.
     """
-    logging.info('validate_coupon_inserted_to_cart - start')
-
-    conn = http.client.HTTPSConnection(cibus_url)
-
-    headers = {
-        'authority': cibus_authority_header,
-        'accept': 'application.json, text/plain, */*',
-        'accept-language': cibus_accept_language_header,
-        'application-id': cibus_application_id_header,
-        'content-type': cibus_content_type_header,
-        'cookie': f'token={token}'
-    }
-
-    payload = {
-        'type': 'prx_simulate_order',
-        'order_time': order_time
-    }
-
-    payload = convert_json_to_string(payload)
-
-    conn.request('POST', '/api/main.py', payload, headers)
-    res = conn.getresponse()
-
-    if not(200 <= res.status <= 299):
-        logging.error(f'insert_coupon_to_cart, response: {res.status}')
-        logging.error('insert_coupon_to_cart - failed')
-        return False
-
-    data = json.loads(res.read().decode('utf-8'))
-
-    if data['head']['count'] != 1:
-        logging.error('insert_coupon_to_cart - failed')
-        return False
-
-    logging.info('validate_coupon_inserted_to_cart - end')
-
-    return True
-
-
-def purchase_coupon(token, user_id, order_time):
-    """
-    Simulates the purchase of a coupon for a specific user and order time.
-
-    Args:
-        token (str): A user authentication token obtained through login.
-        user_id (int): The user's identifier.
-        order_time (str): The desired order time, formatted as "HH:mm".
-
-    Returns:
-        bool: True if the coupon purchase is successfully simulated, False otherwise.
-    """
-    logging.info('purchase_coupon - start')
-
-    conn = http.client.HTTPSConnection(cibus_url)
-
-    headers = {
-        'authority': cibus_authority_header,
-        'accept': cibus_accept_header,
-        'accept-language': cibus_accept_language_header,
-        'application-id': cibus_application_id_header,
-        'content-type': cibus_content_type_header,
-        'cookie': f'token={token}'
-    }
+    import CibusLogging
 
-    payload = {
-        'type': 'prx_apply_order',
-        'order_time': order_time
-    }
-    payload = convert_json_to_string(payload)
+    connection_string = os.environ.get('AzureWebJobsStorage')
+    if not connection_string:
+        CibusLogging.logger.warning('Cibus Purchase Flow - AzureWebJobsStorage is not set, running without account '
+                                    'leases')
+        return None
 
-    conn.request('POST', '/api/main.py', payload, headers)
-    res = conn.getresponse()
-    data = json.loads(res.read().decode('utf-8'))
+    import CibusAccountLease
+    try:
+        return CibusAccountLease.BlobLeaseStore(connection_string)
+    except ImportError as error:
+        CibusLogging.logger.warning('Cibus Purchase Flow - %s, running without account leases (add '
+                                    'azure-storage-blob to requirements.txt)', error)
+        return None
 
-    # if data['head']['count'] != 1 or data['head']['user_id'] != user_id:
-    #     return False
-
-    logging.info('purchase_coupon - end')
-
-    return True
-
-
-def cibus_coupons_auto_purchase(user_name, password):
-    company = 'מיקרוסופט'  # set Cibus user's company
-
-    logging.info('Cibus Purchase Flow - Start')
-
-    token = get_user_token(user_name, password, company)
-
-    user_id, user_budget = get_user_data(token)
-
-    logging.info(f'Cibus Purchase Flow - User Budget: {user_budget}')
-
-    coupons = get_available_coupons(token)
-
-    coupon_values = list(coupons.keys())
-
-    best_coupons_combination, _ = get_best_combination(coupon_values, int(user_budget), len(coupon_values) - 1)
-
-    for i, coupon_value_count in enumerate(best_coupons_combination):
-        purchase_times = int(coupon_value_count)
-        for j in range(purchase_times):
-            coupon_value = coupon_values[i]
-            dish_id = coupons[coupon_value]
-
-            token = get_user_token(user_name, password, company)
-
-            order_time = get_order_time(token)
-
-            is_inserted_to_cart = insert_coupon_to_cart(token, dish_id, coupon_value)
-            # is_inserted_to_cart = is_inserted_to_cart and validate_coupon_inserted_to_cart(token, order_time)
-            logging.info(
-                f'coupon insert to card, value: {coupon_value}, {j + 1} of {purchase_times} times - {"success" if is_inserted_to_cart else "failed"}')
-
-            if is_inserted_to_cart:
-                is_coupon_purchased = purchase_coupon(token, user_id, order_time)
-                logging.info(
-                    f'coupon purchased, value: {coupon_value}, {j + 1} of {purchase_times} times - {"success" if is_coupon_purchased else "failed"}')
-
-    logging.info('Cibus Purchase Flow - End')
 
 app = func.FunctionApp()
 
 @app.timer_trigger(schedule="0 */10 20 * * SUN-THU", arg_name="myTimer", run_on_startup=False,
-              use_monitor=False) 
+              use_monitor=False)
 def every_10min_from_20pm_to_21pm_from_sunday_to_thursday(myTimer: func.TimerRequest) -> None:
-    user_name = ""  # set Cibus user name
-    password = ""  # set Cibus user's password
+    import CibusPurchaseEngine
+
+    setup_logging()
 
-    if not test_mode or is_valid_time():
-        cibus_coupons_auto_purchase(user_name, password)
+    if test_mode and not CibusPurchaseEngine.is_valid_time():
+        return
+
+    accounts = get_accounts_roster()
+    if len(accounts) == 1:
+        user_name, password, solver_policy = accounts[0]
+        CibusPurchaseEngine.cibus_coupons_auto_purchase(user_name, password, solver_policy, get_lease_store())
+    else:
+        import CibusPipeline
+        stage_settings, solve_process_workers = get_pipeline_settings()
+        CibusPipeline.run_purchase_pipeline(accounts, get_lease_store(), stage_settings, solve_process_workers)
 
 @app.route(route="http_trigger", auth_level=func.AuthLevel.ANONYMOUS)
 def http_trigger(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('Cibus Purchase Flow - HTTP Trigged')
+    import CibusLogging
+    import CibusPurchaseEngine
+
+    setup_logging()
+
+    CibusLogging.logger.info('Cibus Purchase Flow - HTTP Trigged')
 
     # Get the query parameters from the request
     query_params = req.params
@@ -460,9 +153,19 @@ def http_trigger(req: func.HttpRequest) -> func.HttpResponse:
     # You can now access individual query parameters by name
     user_name = query_params.get("username")
     password = query_params.get("password")
+    solver_policy = query_params.get("solver_policy", CibusPurchaseEngine.default_solver_policy)
+
+    if not user_name or not password:
+        return func.HttpResponse("The username and password query parameters are required.", status_code=400)
+
+    try:
+        CibusPurchaseEngine.get_solver_policy(solver_policy)
+    except ValueError as error:
+        return func.HttpResponse(f"Invalid solver policy: {error}.", status_code=400)
 
-    logging.info(f'Cibus Purchase Flow - HTTP Trigged - Username: {user_name}')
+    CibusLogging.logger.info('Cibus Purchase Flow - HTTP Trigged - Account: %s',
+                             CibusLogging.get_account_tag(user_name))
 
-    cibus_coupons_auto_purchase(user_name, password)
+    CibusPurchaseEngine.cibus_coupons_auto_purchase(user_name, password, solver_policy, get_lease_store())
 
     return func.HttpResponse(f"Hello, {user_name}. This HTTP triggered function executed successfully.")
@@ -0,0 +1,208 @@
+import atexit
+import contextlib
+import contextvars
+import hashlib
+import json
+import logging
+import queue
+import threading
+import uuid
+from datetime import datetime, timezone
+
+# The purchase flow logs through this logger with %-style arguments, so disabled lines are never formatted.
+# Every record carries the correlation fields of the current log context, and the repetitive records (logged with
+# extra=sampled) are sampled per run and message. With enable_queue_logging, records are formatted and written by a
+# background thread, off the purchase hot path.
+logger = logging.getLogger('cibus')
+
+correlation_fields = ('run_id', 'account', 'coupon')
+sampled = {'sampled': True}  # extra of the repetitive records, e.g. the per-coupon lines
+
+sampling_first = 3  # the first records of a repetitive line in a run that are always logged
+sampling_every = 10  # after them, one of every sampling_every records is logged
+
+_log_context = contextvars.ContextVar('cibus_log_context', default={})
+_queue_listener = None
+_queue_listener_lock = threading.Lock()
+
+
+def get_account_tag(user_name):
+    """
+    Converts a Cibus user name into a short account tag for the logs, so the logs don't hold user names.
+
+    Args:
+        user_name (str): The username of the user.
+
+    Returns:
+        str: The account tag.
+    """
+    return hashlib.sha256(user_name.encode('utf-8')).hexdigest()[:10]
+
+
+def new_run_id():
+    """
+    Returns:
+        str: A new run correlation id.
+    """
+    return uuid.uuid4().hex[:12]
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """
+    Adds correlation fields (run_id, account, coupon) to the records logged inside the context, on this thread.
+
+    Args:
+        **fields: The correlation fields to add or override.
+    """
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+def get_log_context():
+    """
+    Returns:
+        dict: The correlation fields of the current log context.
+    """
+    return dict(_log_context.get())
+
+
+class CorrelationFilter(logging.Filter):
+    """
+    Sets the correlation fields of the current log context on every record.
+    """
+
+    def filter(self, record):
+        context = _log_context.get()
+        for field in correlation_fields:
+            setattr(record, field, context.get(field))
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Samples the repetitive records - the first ones of every run and message are logged, and then one of every
+    few. Warnings and errors are never sampled out.
+    """
+
+    max_tracked_lines = 10000
+
+    def __init__(self, first=sampling_first, every=sampling_every):
+        super().__init__()
+        self.first = first
+        self.every = every
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not getattr(record, 'sampled', False):
+            return True
+
+        key = (getattr(record, 'run_id', None), record.msg)
+        with self._lock:
+            if len(self._counts) >= self.max_tracked_lines:
+                self._counts.clear()
+            count = self._counts[key] = self._counts.get(key, 0) + 1
+
+        return count <= self.first or (count - self.first) % self.every == 0
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats records as JSON lines with their correlation fields.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        entry.update({field: getattr(record, field) for field in correlation_fields
+                      if getattr(record, field, None) is not None})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _ForwardingHandler(logging.Handler):
+    """
+    Formats records as structured lines on the queue listener thread, and forwards them to the target handlers.
+    """
+
+    def __init__(self, target_handlers):
+        super().__init__()
+        self.target_handlers = target_handlers
+        self.setFormatter(StructuredFormatter())
+
+    def emit(self, record):
+        line = logging.makeLogRecord({**record.__dict__, 'msg': self.format(record), 'args': None,
+                                      'exc_info': None, 'exc_text': None})
+        for handler in self.target_handlers:
+            if line.levelno >= handler.level:
+                handler.handle(line)
+
+
+def enable_queue_logging(target_handlers=None):
+    """
+    Moves the purchase flow records off the logging thread - they're put on a queue as is, and a background
+    listener thread formats them as structured lines and writes them to the target handlers. Records written by the
+    listener thread are no longer associated with the azure function invocation, the correlation fields identify
+    them instead. Calling it again does nothing.
+
+    Args:
+        target_handlers (list): The handlers to write to, the root logger handlers by default.
+    """
+    global _queue_listener
+
+    import logging.handlers
+
+    class UnformattedQueueHandler(logging.handlers.QueueHandler):
+        # QueueHandler formats the message before queueing it, which would format on the logging thread
+        def prepare(self, record):
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            return record
+
+    with _queue_listener_lock:
+        if _queue_listener is not None:
+            return
+
+        records_queue = queue.SimpleQueue()
+        forwarding_handler = _ForwardingHandler(list(target_handlers or logging.getLogger().handlers))
+        _queue_listener = logging.handlers.QueueListener(records_queue, forwarding_handler)
+        _queue_listener.start()
+
+        logger.addHandler(UnformattedQueueHandler(records_queue))
+        logger.propagate = False
+        atexit.register(disable_queue_logging)
+
+
+def disable_queue_logging():
+    """
+    Writes the queued records, stops the queue listener thread, and logs on the logging thread again.
+    """
+    global _queue_listener
+
+    import logging.handlers
+
+    with _queue_listener_lock:
+        if _queue_listener is None:
+            return
+
+        for handler in list(logger.handlers):
+            if isinstance(handler, logging.handlers.QueueHandler):
+                logger.removeHandler(handler)
+        logger.propagate = True
+        _queue_listener.stop()
+        _queue_listener = None
+
+
+logger.addFilter(CorrelationFilter())
+logger.addFilter(SamplingFilter())
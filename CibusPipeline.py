@@ -0,0 +1,372 @@
+import contextlib
+import logging
+import queue
+import threading
+import time
+
+import CibusLogging
+import CibusPurchaseEngine
+from CibusLogging import logger
+
+# The purchase flow of many accounts as a pipeline of stages joined by bounded queues:
+# authenticate -> fetch (user data and menu) -> solve -> cart <-> checkout
+# Each stage has its own worker threads, and a full queue blocks the stage before it (backpressure). An account
+# loops between the cart and checkout stages once per coupon, so the accounts in that loop are capped by the smaller
+# of the cart and checkout queue sizes, which keeps the loop from blocking on its own queues.
+
+# The workers and queue size of each stage
+default_stage_settings = {
+    'authenticate': (4, 16),
+    'fetch': (4, 16),
+    'solve': (2, 16),
+    'cart': (8, 32),
+    'checkout': (8, 32),
+}
+
+
+class AccountJob:
+    """
+    The state of an account as it passes through the pipeline stages.
+    """
+
+    def __init__(self, user_name, password, solver_policy=None):
+        self.user_name = user_name
+        self.password = password
+        self.solver_policy = solver_policy
+        self.run_id = CibusLogging.new_run_id()
+        self.account_tag = CibusLogging.get_account_tag(user_name)
+        self.resources = contextlib.ExitStack()  # e.g. the account lease, closed when the account completes
+        self.lease = None
+        self.token = None
+        self.user_id = None
+        self.user_budget = None
+        self.coupons = None
+        self.coupon_values = None
+        self.purchase_plans = None
+        self.plan_index = 0
+        self.handled_combination = None
+        self.failed_indices = set()
+        self.coupon_index = None
+        self.cart_fill = None  # the cart filled by pipelined inserts, see CibusPurchaseEngine.fill_cart_pipelined
+        self.cart_pipeline_depth = 1
+        self.order_time = None
+        self.purchased_count = 0
+        self.error = None
+
+
+class PipelineStage:
+    """
+    A pipeline stage - a bounded input queue, and worker threads that handle its jobs.
+    """
+
+    def __init__(self, name, handler, workers, queue_size):
+        """
+        Args:
+            name (str): The stage name.
+            handler (function): Handles a job, and returns the name of the stage to pass it to, or None if the
+                account completed.
+            workers (int): The number of worker threads.
+            queue_size (int): The maximal number of jobs waiting in the input queue.
+        """
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(queue_size)
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, job):
+        self.queue.put(job)
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def start(self, route):
+        """
+        Starts the worker threads.
+
+        Args:
+            route (function): Passes a handled job and the returned stage name on.
+        """
+        for worker_index in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(route,), name=f'{self.name}-{worker_index}',
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self, route):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+
+            start = time.perf_counter()
+            try:
+                with CibusLogging.log_context(run_id=job.run_id, account=job.account_tag):
+                    next_stage = self.handler(job)
+            except Exception as error:
+                with CibusLogging.log_context(run_id=job.run_id, account=job.account_tag):
+                    logger.exception('Cibus Pipeline - %s failed', self.name)
+                job.error = error
+                next_stage = None
+            with self._lock:
+                self.busy_seconds += time.perf_counter() - start
+                self.processed += 1
+                self.failed += job.error is not None
+
+            route(job, next_stage)
+
+    def get_stats(self, elapsed_seconds):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'processed': self.processed,
+                'failed': self.failed,
+                'throughput': self.processed / elapsed_seconds if elapsed_seconds else 0,
+                'utilization': self.busy_seconds / (elapsed_seconds * self.workers) if elapsed_seconds else 0,
+                'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+            }
+
+
+class PurchasePipeline:
+    """
+    Runs the purchase flow of many accounts through the pipeline stages.
+    """
+
+    def __init__(self, stage_settings=None, lease_store=None, solve_process_workers=0):
+        """
+        Args:
+            stage_settings (dict): The (workers, queue size) of each stage, overriding default_stage_settings.
+            lease_store: The account lease store, see CibusAccountLease, or None to run without leases.
+            solve_process_workers (int): The number of solver processes, or 0 to solve in the solve stage threads.
+                Solving in processes requires picklable solver policies, e.g. policy names or specs.
+
+        Raises:
+            ValueError: If a stage is unknown, or has less than one worker or a queue size below 1 (queue.Queue
+                treats 0 as unbounded, which would leave no room in the cart <-> checkout loop).
+        """
+        unknown_stages = set(stage_settings or {}) - set(default_stage_settings)
+        if unknown_stages:
+            raise ValueError(f'unknown pipeline stages: {sorted(unknown_stages)}, '
+                             f'expected: {list(default_stage_settings)}')
+        stage_settings = {**default_stage_settings, **(stage_settings or {})}
+        for name, (workers, queue_size) in stage_settings.items():
+            if workers < 1 or queue_size < 1:
+                raise ValueError(f'pipeline stage {name} must have at least one worker and a queue size of at least 1, '
+                                 f'got: ({workers}, {queue_size})')
+        if solve_process_workers < 0:
+            raise ValueError(f'solve_process_workers must not be negative, got: {solve_process_workers}')
+        handlers = {
+            'authenticate': self._authenticate,
+            'fetch': self._fetch,
+            'solve': self._solve,
+            'cart': self._insert_to_cart,
+            'checkout': self._checkout,
+        }
+        self.stages = {name: PipelineStage(name, handler, *stage_settings[name]) for name, handler in handlers.items()}
+        self.lease_store = lease_store
+        self.solve_process_workers = solve_process_workers
+        self._process_pool = None
+        # accounts in the cart <-> checkout loop, see the module comment
+        self._cart_slots = threading.Semaphore(min(stage_settings['cart'][1], stage_settings['checkout'][1]))
+        self._pending_accounts = 0
+        self._completed = threading.Condition()
+        self._started = None
+        self.completed_jobs = []
+
+    def _authenticate(self, job):
+        if self.lease_store is not None:
+            import CibusAccountLease
+
+            job.lease = job.resources.enter_context(CibusAccountLease.account_lease(self.lease_store, job.user_name))
+            if job.lease is None:
+                logger.info('Cibus Pipeline - the account is processed by another worker, skipped')
+                return None
+
+        job.token = CibusPurchaseEngine.get_user_token(job.user_name, job.password, CibusPurchaseEngine.cibus_company)
+        return 'fetch'
+
+    def _fetch(self, job):
+        job.user_id, job.user_budget = CibusPurchaseEngine.get_user_data(job.token)
+        job.coupons = CibusPurchaseEngine.get_available_coupons(job.token)
+        job.coupon_values = list(job.coupons.keys())
+        return 'solve'
+
+    def _solve(self, job):
+        solve_arguments = (job.coupon_values, int(job.user_budget), job.solver_policy,
+                           CibusPurchaseEngine.fallback_plans_count + 1, True)  # with diverse fallback plans
+        if self._process_pool is not None:
+            job.purchase_plans = self._process_pool.submit(CibusPurchaseEngine.solve_coupon_combinations,
+                                                           *solve_arguments).result()
+        else:
+            job.purchase_plans = CibusPurchaseEngine.solve_coupon_combinations(*solve_arguments)
+
+        if not job.purchase_plans:
+            logger.error('Cibus Pipeline - no coupons combination satisfies the solver policy')
+            return None
+
+        self._cart_slots.acquire()
+        job.handled_combination = [0] * len(job.coupon_values)
+        job.cart_pipeline_depth = CibusPurchaseEngine.get_cart_pipeline_depth()
+        return 'cart'
+
+    def _insert_to_cart(self, job):
+        while True:
+            coupons_combination, _ = job.purchase_plans[job.plan_index]
+            job.coupon_index = CibusPurchaseEngine.get_next_coupon_index(coupons_combination,
+                                                                        job.handled_combination)
+            if job.coupon_index is None:
+                return None
+
+            if job.lease is not None and job.lease.lost:
+                logger.error('Cibus Pipeline - the account lease is lost, stopping')
+                return None
+
+            batch_indices = CibusPurchaseEngine.get_next_coupon_indices(coupons_combination, job.handled_combination,
+                                                                        job.cart_pipeline_depth)
+            if len(batch_indices) > 1:
+                cart_fill = CibusPurchaseEngine.fill_cart_pipelined(job.user_name, job.password, job.coupons,
+                                                                    job.coupon_values, batch_indices,
+                                                                    job.cart_pipeline_depth)
+                job.cart_pipeline_depth = cart_fill.cart_pipeline_depth
+                if cart_fill.cart_indices or cart_fill.is_cart_unknown:
+                    job.cart_fill = cart_fill
+                    return 'checkout'
+                continue
+
+            coupon_value = job.coupon_values[job.coupon_index]
+            job.token = CibusPurchaseEngine.get_user_token(job.user_name, job.password,
+                                                           CibusPurchaseEngine.cibus_company)
+            job.order_time = CibusPurchaseEngine.get_order_time(job.token)
+            if CibusPurchaseEngine.insert_coupon_to_cart(job.token, job.coupons[coupon_value], coupon_value):
+                return 'checkout'
+
+            job.failed_indices.add(job.coupon_index)
+            job.plan_index = CibusPurchaseEngine.get_fallback_plan_index(job.purchase_plans, job.plan_index,
+                                                                         job.handled_combination, job.failed_indices)
+            if job.plan_index is None:
+                logger.error('Cibus Pipeline - no fallback plan without coupon value: %s', coupon_value)
+                return None
+            logger.info('Cibus Pipeline - switched to fallback plan %s', job.plan_index)
+
+    def _checkout(self, job):
+        if job.cart_fill is None:
+            if CibusPurchaseEngine.purchase_coupon(job.token, job.user_id, job.order_time):
+                job.purchased_count += 1
+            job.handled_combination[job.coupon_index] += 1
+            return 'cart'
+
+        cart_fill, job.cart_fill = job.cart_fill, None
+        is_purchased = CibusPurchaseEngine.check_out_cart(cart_fill, job.user_id, job.coupon_values)
+        if cart_fill.is_cart_unknown:
+            job.purchase_plans = CibusPurchaseEngine.replan_purchase(cart_fill.token, job.coupon_values,
+                                                                     job.solver_policy)
+            if not job.purchase_plans:
+                logger.info('Cibus Pipeline - no coupons combination for the remaining budget')
+                return None
+            job.plan_index = 0
+            job.handled_combination = [0] * len(job.coupon_values)
+            job.failed_indices = set()
+            job.purchased_count = 0  # the coupons purchased by the plan of the remaining budget
+            return 'cart'
+
+        if is_purchased:
+            job.purchased_count += len(cart_fill.cart_indices)
+        for k in cart_fill.cart_indices:
+            job.handled_combination[k] += 1
+        return 'cart'
+
+    def _route(self, job, next_stage):
+        if next_stage is not None:
+            self.stages[next_stage].submit(job)
+            return
+
+        if job.handled_combination is not None:
+            self._cart_slots.release()
+        try:
+            job.resources.close()
+        except Exception:
+            logger.exception('Cibus Pipeline - releasing the account resources failed')
+        with self._completed:
+            self.completed_jobs.append(job)
+            self._pending_accounts -= 1
+            self._completed.notify_all()
+
+    def run(self, accounts):
+        """
+        Runs the purchase flow of the accounts through the pipeline, and waits for all of them to complete.
+
+        Args:
+            accounts (list): The accounts, as (user name, password, solver policy) tuples.
+
+        Returns:
+            list: The completed AccountJob of each account.
+        """
+        if self.solve_process_workers:
+            import concurrent.futures
+            import multiprocessing
+            # spawned, as forking this process while the stage, lease renewal and logging threads run may deadlock
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                self.solve_process_workers, mp_context=multiprocessing.get_context('spawn'))
+
+        self.completed_jobs = []
+        self._started = time.perf_counter()
+        for stage in self.stages.values():
+            stage.start(self._route)
+
+        try:
+            for user_name, password, solver_policy in accounts:
+                with self._completed:
+                    self._pending_accounts += 1
+                self.stages['authenticate'].submit(AccountJob(user_name, password, solver_policy))
+
+            with self._completed:
+                self._completed.wait_for(lambda: self._pending_accounts == 0)
+        finally:
+            for stage in self.stages.values():
+                stage.stop()
+            if self._process_pool is not None:
+                self._process_pool.shutdown()
+                self._process_pool = None
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Cibus Pipeline - completed %s accounts, stats: %s', len(self.completed_jobs), self.get_stats())
+        return self.completed_jobs
+
+    def get_stats(self):
+        """
+        Returns:
+            dict: The stats of each stage by name - workers, processed and failed jobs, throughput (jobs per
+                second), utilization, and current and maximal queue depth.
+        """
+        elapsed_seconds = time.perf_counter() - self._started if self._started is not None else 0
+        return {name: stage.get_stats(elapsed_seconds) for name, stage in self.stages.items()}
+
+
+def run_purchase_pipeline(accounts, lease_store=None, stage_settings=None, solve_process_workers=0):
+    """
+    Runs the purchase flow of many accounts through a new pipeline.
+
+    Args:
+        accounts (list): The accounts, as (user name, password, solver policy) tuples.
+        lease_store: The account lease store, see CibusAccountLease, or None to run without leases.
+        stage_settings (dict): The (workers, queue size) of each stage, overriding default_stage_settings.
+        solve_process_workers (int): The number of solver processes, or 0 to solve in the solve stage threads.
+
+    Returns:
+        tuple: The completed AccountJob of each account (list), and the pipeline stats (dict).
+    """
+    pipeline = PurchasePipeline(stage_settings, lease_store, solve_process_workers)
+    completed_jobs = pipeline.run(accounts)
+    return completed_jobs, pipeline.get_stats()
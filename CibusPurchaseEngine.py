@@ -0,0 +1,1241 @@
+import bisect
+import collections
+import contextlib
+import contextvars
+import functools
+import math
+import os
+import time
+from datetime import datetime
+import json
+import sys
+import threading
+
+import CibusLogging
+from CibusLogging import logger, sampled
+
+cibus_auth_url = 'api.capir.pluxee.co.il'
+cibus_auth_authority_header = 'capir.mysodexo.co.il'
+
+cibus_url = 'api.consumers.pluxee.co.il'
+cibus_authority_header = 'api.mysodexo.co.il'
+cibus_accept_header = 'application/json, text/plain, */*'
+cibus_accept_language_header = 'he'
+cibus_application_id_header = 'E5D5FEF5-A05E-4C64-AEBA-BA0CECA0E402'
+cibus_content_type_header = 'application/json; charset=UTF-8'
+cibus_cache_control = 'no-cache'
+cibus_company = 'מיקרוסופט'  # set Cibus user's company
+
+comp_id = 2199
+restaurant_id = 37829
+order_type = 2
+address_id = 1000849267
+category_id = 4755799
+
+connection_factory = None  # set to a function of the host, to replace the HTTPS connections (e.g. cassettes)
+
+profile_dir_environment_variable = 'CIBUS_PROFILE_DIR'  # set to a directory, to profile the purchase flow into it
+profile_top_allocations_count = 25
+# the wall-clock seconds of each phase of the profiled run, None when not profiling
+_profile_phase_durations = contextvars.ContextVar('cibus_profile_phase_durations', default=None)
+_profile_lock = threading.Lock()  # cProfile and tracemalloc are per process, so one run is profiled at a time
+
+fallback_plans_count = 5  # alternative plans to switch to when a coupon value goes out of stock
+
+# set to the number of prx_add_prod_to_cart requests to keep in flight, to fill the cart with several coupons and
+# check them out in one order - 1 (the default) inserts and checks out the coupons one by one
+cart_pipeline_depth_environment_variable = 'CIBUS_CART_PIPELINE_DEPTH'
+
+# a cart filled by fill_cart_pipelined - the session, the coupon value index of each coupon in the cart, the depth to
+# continue with, and whether the cart contents are unknown
+CartFill = collections.namedtuple('CartFill', ['token', 'order_time', 'cart_indices', 'cart_pipeline_depth',
+                                               'is_cart_unknown'])
+
+
+def is_valid_time():
+    # Get the current date and time
+    current_time = datetime.now()
+    logger.info('is_valid_time - Current Time: %s', current_time)
+
+    # Check if the current day is not Friday or Saturday
+    if current_time.weekday() not in [4, 5]:
+        # Check if the current time is between 8pm and 9pm
+        if 20 <= current_time.hour < 21:
+            logger.info('is_valid_time - valid time')
+            return True
+    logger.info('is_valid_time - Doesn\'t valid time')
+    return False
+
+
+def create_connection(host):
+    """
+    Opens a connection to a Cibus host, through the connection factory if one is set, and over the transport of the
+    CIBUS_TRANSPORT app setting otherwise.
+
+    Args:
+        host (str): The Cibus host to connect to.
+
+    Returns:
+        http.client.HTTPSConnection: The connection, or a connection-like object created by the factory or transport.
+    """
+    if connection_factory is not None:
+        return connection_factory(host)
+
+    # imported on first use, as it loads ssl and the email parser
+    import CibusTransport
+    return CibusTransport.create_connection(host)
+
+
+@contextlib.contextmanager
+def profile_phase(phase):
+    """
+    Measures the wall-clock duration of a purchase flow phase, when the purchase flow is profiled.
+
+    Args:
+        phase (str): The phase name, durations of the same phase are summed.
+    """
+    phase_durations = _profile_phase_durations.get()
+    if phase_durations is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_durations[phase] = phase_durations.get(phase, 0) + time.perf_counter() - start
+
+
+def convert_json_to_string(json_object):
+    """
+    Converts a JSON object into a JSON string.
+
+    Args:
+        json_object (dict): A dictionary representing a JSON object.
+
+    Returns:
+        str: A JSON string representation of the input JSON object.
+    """
+    return json.dumps(json_object)
+
+
+def _min_coupons_to_reach(missing_value, remaining_values):
+    """
+    Calculates a lower bound on the number of coupons still needed to cover the missing value.
+
+    Args:
+        missing_value (int): The value still missing to reach the target value.
+        remaining_values (list): The coupon values that may still be added.
+
+    Returns:
+        int: The minimal number of coupons to add, or None if the missing value can't be covered.
+    """
+    if missing_value <= 0:
+        return 0
+    if not remaining_values:
+        return None
+    return math.ceil(missing_value / max(remaining_values))
+
+
+def _values_gcd(remaining_values):
+    """
+    Calculates the step size of the totals reachable by adding coupons of the remaining values.
+
+    Args:
+        remaining_values (list): The coupon values that may still be added.
+
+    Returns:
+        int: The greatest common divisor of the remaining values, or 0 if there are none or a value isn't a whole
+            number, as the step of fractional menu prices isn't tracked.
+    """
+    if not all(float(value).is_integer() for value in remaining_values):
+        return 0
+    return functools.reduce(math.gcd, (int(value) for value in remaining_values), 0)
+
+
+class CoverBudgetObjective:
+    """
+    The minimal total that covers the budget, tie-broken on the fewest coupons.
+
+    An objective scores a complete combination and bounds every completion of a partial one. Scores are tuples
+    compared lexicographically where lower is better, and None marks an infeasible combination. The first two
+    items of a score are always (budget distance, coupon count).
+    """
+
+    def score(self, coupon_values_array, combination, total_value, coupon_count, target_value):
+        if total_value < target_value:
+            return None
+        return total_value - target_value, coupon_count
+
+    def lower_bound(self, coupon_values_array, combination, total_value, coupon_count, target_value,
+                    remaining_values):
+        missing_value = target_value - total_value
+        if missing_value <= 0:
+            return -missing_value, coupon_count
+
+        coupons_to_add = _min_coupons_to_reach(missing_value, remaining_values)
+        if coupons_to_add is None:
+            return None
+
+        # the reachable totals are spaced by the gcd of the remaining values
+        values_gcd = _values_gcd(remaining_values)
+        overshoot = -missing_value % values_gcd if values_gcd else 0
+        return overshoot, coupon_count + coupons_to_add
+
+
+class WithinBudgetObjective:
+    """
+    The maximal total that doesn't exceed the budget, tie-broken on the fewest coupons.
+    """
+
+    def score(self, coupon_values_array, combination, total_value, coupon_count, target_value):
+        if total_value > target_value:
+            return None
+        return target_value - total_value, coupon_count
+
+    def lower_bound(self, coupon_values_array, combination, total_value, coupon_count, target_value,
+                    remaining_values):
+        missing_value = target_value - total_value
+        if missing_value < 0:
+            return None
+        if not remaining_values:
+            return missing_value, coupon_count
+
+        # the best completion can only add whole steps of the remaining values gcd
+        values_gcd = _values_gcd(remaining_values)
+        unspent = missing_value % values_gcd if values_gcd else 0
+        coupons_to_add = _min_coupons_to_reach(missing_value - unspent, remaining_values)
+        return unspent, coupon_count + coupons_to_add
+
+
+class DenominationPreferenceObjective:
+    """
+    Wraps another objective, and among the combinations it ranks equally on budget distance, prefers the ones
+    with the lowest total penalty of the used coupon values.
+    """
+
+    def __init__(self, penalties, base_objective=None):
+        """
+        Args:
+            penalties (dict): A non-negative penalty per coupon (int) for each coupon value (int). Values that
+                are not listed have no penalty, so listing the unwanted values prefers the other ones.
+            base_objective: The objective deciding the budget distance, CoverBudgetObjective by default.
+        """
+        self.penalties = penalties
+        self.base_objective = base_objective or CoverBudgetObjective()
+
+    def _penalty(self, coupon_values_array, combination):
+        return sum(self.penalties.get(value, 0) * count for value, count in zip(coupon_values_array, combination))
+
+    def score(self, coupon_values_array, combination, total_value, coupon_count, target_value):
+        base_score = self.base_objective.score(coupon_values_array, combination, total_value, coupon_count,
+                                               target_value)
+        if base_score is None:
+            return None
+        return (base_score[0], self._penalty(coupon_values_array, combination)) + base_score[1:]
+
+    def lower_bound(self, coupon_values_array, combination, total_value, coupon_count, target_value,
+                    remaining_values):
+        base_bound = self.base_objective.lower_bound(coupon_values_array, combination, total_value, coupon_count,
+                                                     target_value, remaining_values)
+        if base_bound is None:
+            return None
+
+        # every coupon the base bound still requires costs at least the cheapest remaining penalty
+        penalty = self._penalty(coupon_values_array, combination)
+        coupons_to_add = base_bound[1] - coupon_count
+        if coupons_to_add > 0:
+            penalty += coupons_to_add * min(self.penalties.get(value, 0) for value in remaining_values)
+        return (base_bound[0], penalty) + base_bound[1:]
+
+
+def max_coupons_constraint(max_coupons):
+    """
+    Creates a constraint that caps the number of coupons purchased in a single run.
+
+    Constraints are called with every partial combination, and must be monotone: once a partial combination
+    violates a constraint, so does every combination that extends it.
+
+    Args:
+        max_coupons (int): The maximal number of coupons in a combination.
+
+    Returns:
+        function: The constraint function.
+    """
+    def constraint(coupon_values_array, combination, total_value, coupon_count, target_value):
+        return coupon_count <= max_coupons
+
+    return constraint
+
+
+def max_coupon_value_count_constraint(max_counts):
+    """
+    Creates a constraint that caps the number of coupons of specific coupon values.
+
+    Args:
+        max_counts (dict): The maximal number of coupons (int) for each capped coupon value (int).
+
+    Returns:
+        function: The constraint function.
+    """
+    def constraint(coupon_values_array, combination, total_value, coupon_count, target_value):
+        return all(count <= max_counts.get(value, count) for value, count in zip(coupon_values_array, combination))
+
+    return constraint
+
+
+SolverPolicy = collections.namedtuple('SolverPolicy', ['objective', 'constraints'])
+
+solver_policies = {
+    'cover_budget': SolverPolicy(CoverBudgetObjective(), []),
+    'within_budget': SolverPolicy(WithinBudgetObjective(), []),
+}
+default_solver_policy = 'cover_budget'
+
+
+solver_policy_spec_keys = ('objective', 'penalties', 'max_coupons', 'max_coupon_value_counts')
+
+
+def _parse_spec_number(key, value, value_type):
+    # bool is an int, and float() and int() accept strings, so a mistyped spec must be rejected explicitly
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or (value_type is int and value != int(value)):
+        raise ValueError(f'solver policy {key} must be {"an integer" if value_type is int else "a number"}, '
+                         f'got: {value!r}')
+    return value_type(value)
+
+
+def _parse_coupon_value_map(spec, key, value_type):
+    value_map = spec.get(key) or {}
+    if not isinstance(value_map, dict):
+        raise ValueError(f'solver policy {key} must be an object of coupon values, got: {value_map!r}')
+
+    parsed_map = {}
+    for coupon_value, count in value_map.items():
+        # JSON object keys are strings, and the coupon values are menu prices - numbers that compare equal to floats
+        try:
+            parsed_coupon_value = float(coupon_value)
+        except (TypeError, ValueError):
+            raise ValueError(f'solver policy {key} keys must be coupon values, got: {coupon_value!r}') from None
+        parsed_map[parsed_coupon_value] = _parse_spec_number(f'{key} of {coupon_value}', count, value_type)
+    return parsed_map
+
+
+def build_solver_policy(spec):
+    """
+    Builds a solver policy from a per-account spec, e.g.
+    {"objective": "within_budget", "max_coupons": 3, "penalties": {"50": 1}, "max_coupon_value_counts": {"200": 1}}.
+
+    Args:
+        spec (dict): The spec - objective (str): the name of the solver policy to extend, default_solver_policy by
+            default, penalties (dict): the denomination preference penalty of coupon values, see
+            DenominationPreferenceObjective, max_coupons (int): the maximal number of coupons, see
+            max_coupons_constraint, max_coupon_value_counts (dict): the maximal number of coupons of coupon values,
+            see max_coupon_value_count_constraint.
+
+    Returns:
+        SolverPolicy: The solver policy.
+
+    Raises:
+        ValueError: If the spec is invalid.
+    """
+    unknown_keys = set(spec) - set(solver_policy_spec_keys)
+    if unknown_keys:
+        raise ValueError(f'unknown solver policy keys: {sorted(unknown_keys)}, expected: {solver_policy_spec_keys}')
+
+    objective_name = spec.get('objective', default_solver_policy)
+    if not isinstance(objective_name, str) or objective_name.lstrip().startswith('{'):
+        raise ValueError(f'solver policy objective must be a solver policy name, got: {objective_name!r}')
+    base_policy = get_solver_policy(objective_name)
+    objective = base_policy.objective
+    constraints = list(base_policy.constraints)
+
+    penalties = _parse_coupon_value_map(spec, 'penalties', float)
+    if penalties:
+        objective = DenominationPreferenceObjective(penalties, objective)
+    if spec.get('max_coupons') is not None:
+        constraints.append(max_coupons_constraint(_parse_spec_number('max_coupons', spec['max_coupons'], int)))
+    max_coupon_value_counts = _parse_coupon_value_map(spec, 'max_coupon_value_counts', int)
+    if max_coupon_value_counts:
+        constraints.append(max_coupon_value_count_constraint(max_coupon_value_counts))
+
+    return SolverPolicy(objective, constraints)
+
+
+def get_solver_policy(solver_policy):
+    """
+    Resolves a solver policy given by name, by a per-account spec, or as a SolverPolicy.
+
+    Args:
+        solver_policy (str | dict | SolverPolicy): A name from solver_policies, a spec (see build_solver_policy) or
+            its JSON string, a SolverPolicy, or None for the default.
+
+    Returns:
+        SolverPolicy: The resolved solver policy.
+
+    Raises:
+        ValueError: If the name is unknown or the spec is invalid.
+    """
+    if solver_policy is None:
+        solver_policy = default_solver_policy
+    if isinstance(solver_policy, str) and solver_policy.lstrip().startswith('{'):
+        solver_policy = json.loads(solver_policy)
+    if isinstance(solver_policy, dict):
+        return build_solver_policy(solver_policy)
+    if isinstance(solver_policy, str):
+        if solver_policy not in solver_policies:
+            raise ValueError(f'unknown solver policy: {solver_policy}, expected one of {sorted(solver_policies)}')
+        return solver_policies[solver_policy]
+    if not isinstance(solver_policy, SolverPolicy):
+        raise ValueError(f'a solver policy must be a name, a spec or a SolverPolicy, got: {solver_policy!r}')
+    return solver_policy
+
+
+def solve_coupon_combinations(coupon_values_array, target_value, solver_policy=None, plans_count=1,
+                              diverse_plans=False):
+    """
+    Finds the best combinations of coupon values for the target value by the solver policy objective, using a
+    single branch-and-bound search over the coupon values from the largest to the smallest, that keeps the
+    ranked plans_count best combinations found so far and prunes by the worst of them.
+
+    The best combinations nearly always share the coupon values of the best one, so with diverse_plans the search
+    also keeps the best combination without each coupon value, for a fallback when that value goes out of stock.
+
+    Args:
+        coupon_values_array (list): A list of coupon values.
+        target_value (int): The target value to be covered by the coupon combination.
+        solver_policy (str | SolverPolicy): The objective and constraints to solve by, see get_solver_policy.
+        plans_count (int): The maximal number of ranked combinations to return.
+        diverse_plans (bool): Whether to add the best combination without each coupon value to the ranked ones.
+
+    Returns:
+        list: The combinations ranked from the best, each a tuple of the count of each coupon value (list) and
+            its total value (int). The list is empty if no combination satisfies the policy.
+    """
+    objective, constraints = get_solver_policy(solver_policy)
+
+    values_count = len(coupon_values_array)
+    search_order = sorted(range(values_count), key=lambda index: coupon_values_array[index], reverse=True)
+    remaining_values = [[coupon_values_array[index] for index in search_order[depth:]]
+                        for depth in range(values_count + 1)]
+    search_depths = {index: depth for depth, index in enumerate(search_order)}
+
+    combination = [0] * values_count
+    ranked_plans = []  # (score, combination, total value), sorted by score
+    plans_without_value = {}  # the best (score, combination, total value) without each coupon value, by its index
+
+    def can_improve_plan_without_value(depth, total_value, coupon_count):
+        for index in range(values_count):
+            if combination[index]:
+                continue
+            values = remaining_values[depth]
+            if search_depths[index] >= depth:
+                values = values[:search_depths[index] - depth] + values[search_depths[index] - depth + 1:]
+            bound = objective.lower_bound(coupon_values_array, combination, total_value, coupon_count, target_value,
+                                          values)
+            if bound is not None and (index not in plans_without_value or bound < plans_without_value[index][0]):
+                return True
+        return False
+
+    def search(depth, total_value, coupon_count):
+        bound = objective.lower_bound(coupon_values_array, combination, total_value, coupon_count, target_value,
+                                      remaining_values[depth])
+        if bound is None:
+            return
+        if len(ranked_plans) == plans_count and bound >= ranked_plans[-1][0] and \
+                not (diverse_plans and can_improve_plan_without_value(depth, total_value, coupon_count)):
+            return
+
+        # adding coupons once the target value is covered never improves a combination
+        if total_value >= target_value or depth == values_count:
+            score = objective.score(coupon_values_array, combination, total_value, coupon_count, target_value)
+            if score is not None:
+                plan = (score, list(combination), total_value)
+                bisect.insort(ranked_plans, plan, key=lambda ranked_plan: ranked_plan[0])
+                del ranked_plans[plans_count:]
+                for index in range(values_count * diverse_plans):
+                    if not combination[index] and (index not in plans_without_value
+                                                   or score < plans_without_value[index][0]):
+                        plans_without_value[index] = plan
+            return
+
+        index = search_order[depth]
+        coupon_value = coupon_values_array[index]
+        for count in range(math.ceil((target_value - total_value) / coupon_value), -1, -1):
+            combination[index] = count
+            if all(constraint(coupon_values_array, combination, total_value + count * coupon_value,
+                              coupon_count + count, target_value) for constraint in constraints):
+                search(depth + 1, total_value + count * coupon_value, coupon_count + count)
+        combination[index] = 0
+
+    if plans_count > 0:
+        search(0, 0, 0)
+
+    for plan in plans_without_value.values():
+        if all(plan[1] != ranked_plan[1] for ranked_plan in ranked_plans):
+            bisect.insort(ranked_plans, plan, key=lambda ranked_plan: ranked_plan[0])
+
+    return [(plan_combination, plan_total_value) for _, plan_combination, plan_total_value in ranked_plans]
+
+
+def solve_coupon_combination(coupon_values_array, target_value, solver_policy=None):
+    """
+    Finds the best combination of coupon values for the target value by the solver policy objective.
+
+    Args:
+        coupon_values_array (list): A list of coupon values.
+        target_value (int): The target value to be covered by the coupon combination.
+        solver_policy (str | SolverPolicy): The objective and constraints to solve by, see get_solver_policy.
+
+    Returns:
+        tuple: The best combination - the count of each coupon value (list), and its total value (int).
+            The combination is None if no combination satisfies the policy.
+    """
+    plans = solve_coupon_combinations(coupon_values_array, target_value, solver_policy)
+    if not plans:
+        return None, None
+    return plans[0]
+
+
+def get_next_coupon_index(coupons_combination, handled_combination):
+    """
+    Finds the coupon value to purchase next by the plan.
+
+    Args:
+        coupons_combination (list): The count of each coupon value in the plan.
+        handled_combination (list): The count of the already handled coupons of each coupon value.
+
+    Returns:
+        int: The index of the next coupon value, or None if all the plan coupons are handled.
+    """
+    return next((i for i, coupon_value_count in enumerate(coupons_combination)
+                 if handled_combination[i] < coupon_value_count), None)
+
+
+def get_next_coupon_indices(coupons_combination, handled_combination, count):
+    """
+    Finds the coupon values to purchase next by the plan, for a pipelined cart fill.
+
+    Args:
+        coupons_combination (list): The count of each coupon value in the plan.
+        handled_combination (list): The count of the already handled coupons of each coupon value.
+        count (int): The maximal number of coupons to return.
+
+    Returns:
+        list: The index of the coupon value of each next coupon, in the plan order, empty if all the plan coupons are
+            handled.
+    """
+    indices = []
+    for i, coupon_value_count in enumerate(coupons_combination):
+        remaining_count = min(int(coupon_value_count) - handled_combination[i], count - len(indices))
+        indices.extend([i] * max(remaining_count, 0))
+    return indices
+
+
+def get_cart_pipeline_depth():
+    """
+    Returns:
+        int: The number of cart inserts to keep in flight, from the CIBUS_CART_PIPELINE_DEPTH app setting.
+
+    Raises:
+        ValueError: If the configured depth isn't a positive integer.
+    """
+    depth = int(os.environ.get(cart_pipeline_depth_environment_variable, 1))
+    if depth < 1:
+        raise ValueError(f'{cart_pipeline_depth_environment_variable} must be positive, got: {depth}')
+    return depth
+
+
+def get_fallback_plan_index(purchase_plans, plan_index, handled_combination, failed_indices):
+    """
+    Finds the next ranked plan that the purchase can switch to, after a coupon value failed to be inserted to the
+    cart. The plan must extend the coupons already handled, without adding coupons of the failed values.
+
+    Args:
+        purchase_plans (list): The ranked plans, as returned by solve_coupon_combinations.
+        plan_index (int): The index of the current plan.
+        handled_combination (list): The count of the already handled coupons of each coupon value.
+        failed_indices (set): The indexes of the coupon values that failed to be inserted to the cart.
+
+    Returns:
+        int: The index of the fallback plan, or None if no plan can be switched to.
+    """
+    for fallback_index in range(plan_index + 1, len(purchase_plans)):
+        fallback_combination, _ = purchase_plans[fallback_index]
+        if all(count >= handled_count for count, handled_count in zip(fallback_combination, handled_combination)) \
+                and all(fallback_combination[i] == handled_combination[i] for i in failed_indices):
+            return fallback_index
+    return None
+
+
+def get_best_combination(coupon_values_array, target_value, i):
+    """
+    Calculates the best combination of coupon values that cover the target value,
+    taking into account the minimum difference between the total coupons value and the target value,
+    and selecting the minimum coupon value for the minimum difference.
+
+    Args:
+        coupon_values_array (list): A list of coupon values.
+        target_value (int): The target value to be covered by the coupon combination.
+        i (int): The index of the last coupon value that may be used.
+
+    Returns:
+        list: The best combination of coupons that covers the target value.
+    """
+    combination, total_value = solve_coupon_combination(coupon_values_array[:i + 1], target_value)
+    if combination is None:
+        return [0] * len(coupon_values_array), sys.maxsize
+    return combination + [0] * (len(coupon_values_array) - i - 1), total_value
+
+
+def get_user_token(user_name, password, company):
+    """
+    Retrieves a user authentication token for the provided user credentials.
+
+    Args:
+        user_name (str): The username of the user.
+        password (str): The password of the user.
+        company (str): The company associated with the user.
+
+    Returns:
+        str: A user authentication token if the authentication is successful.
+    """
+    logger.info('get_user_token - start', extra=sampled)
+
+    conn = create_connection(cibus_auth_url)
+
+    headers = {
+        'authority': cibus_auth_authority_header,
+        'accept': cibus_accept_header,
+        'accept-language': cibus_accept_language_header,
+        'application-id': cibus_application_id_header,
+        'content-type': cibus_content_type_header
+    }
+
+    payload = {
+        "username": user_name,
+        "password": password,
+        "company": company
+    }
+    payload = convert_json_to_string(payload)
+
+    conn.request('POST', '/auth/authToken', payload, headers)
+    res = conn.getresponse()
+
+    data = json.loads(res.read().decode('utf-8'))
+    token = data['data']['token']
+
+    logger.info('get_user_token - end', extra=sampled)
+    return token
+
+
+def get_user_data(token):
+    """
+    Retrieves user data including user ID and budget using an authentication token.
+
+    Args:
+        token (str): A user authentication token obtained through login.
+
+    Returns:
+        tuple: A tuple containing user ID (str) and user budget (float).
+    """
+    logger.info('get_user_data - start')
+
+    conn = create_connection(cibus_url)
+
+    headers = {
+        'authority': cibus_authority_header,
+        'accept': cibus_accept_header,
+        'accept-language': cibus_accept_language_header,
+        'application-id': cibus_application_id_header,
+        'content-type': cibus_content_type_header,
+        'cookie': f'token={token}'
+    }
+
+    payload = ''
+
+    conn.request('GET', '/api/prx_user_info.py', payload, headers)
+    res = conn.getresponse()
+
+    data = json.loads(res.read().decode('utf-8'))
+    user_id = data['user_cibus_id']
+    user_budget = float(data['budget'])
+    logger.info('get_user_data - end')
+
+    return user_id, user_budget
+
+
+def get_available_coupons(token):
+    """
+    Retrieves available coupons for the user using an authentication token.
+
+    Args:
+        token (str): A user authentication token obtained through login.
+
+    Returns:
+        dict: A dictionary containing coupon prices (int) as keys and their respective element IDs (int) as values.
+    """
+    logger.info('get_available_coupons - start')
+
+    conn = create_connection(cibus_url)
+
+    headers = {
+        'authority': cibus_authority_header,
+        'accept': 'application json, text plain, */*',
+        'accept-language': cibus_accept_language_header,
+        'application-id': cibus_application_id_header,
+        'content-type': cibus_content_type_header,
+        'cookie': f'token={token}'
+    }
+
+    payload = ''
+
+    url = f'/api/rest_menu_tree.py?restaurant_id={restaurant_id}&comp_id={comp_id}&order_type={order_type}&element_type_deep=16&lang=he&address_id={address_id}'
+
+    conn.request('GET', url, payload, headers)
+    res = conn.getresponse()
+
+    data = json.loads(res.read().decode('utf-8'))
+
+    coupons_response = data['12'][0]['13']
+    coupons = {item['price']: item['element_id'] for item in coupons_response}
+
+    logger.info('get_available_coupons - end')
+
+    return coupons
+
+
+def get_order_time(token):
+    """
+    Inserts a coupon item with specific dish ID and price into the user's shopping cart.
+
+    Args:
+        token (str): A user authentication token obtained through login.
+        dish_id (int): The unique dish ID of the coupon item to be added to the cart.
+        dish_price (float): The price of the coupon item.
+
+    Returns:
+        bool: True if the coupon item is successfully inserted into the cart, False otherwise.
+    """
+    logger.info('get_order_time - start', extra=sampled)
+
+    conn = create_connection(cibus_url)
+    payload = ''
+    headers = {
+        'accept': cibus_accept_header,
+        'accept-language': cibus_accept_language_header,
+        'application-id': cibus_application_id_header,
+        'cache-control': cibus_cache_control,
+        'content-type': cibus_content_type_header,
+        'cookie': f'token={token}'
+    }
+    conn.request('GET', f'/api/prx_order_times.py?order_type={order_type}&rest_id={restaurant_id}', payload, headers)
+    res = conn.getresponse()
+
+    if not(200 <= res.status <= 299):
+        logger.error('get_order_time, response: %s', res.status)
+        logger.error('get_order_time - failed')
+        return False
+
+    data = json.loads(res.read().decode('utf-8'))
+    order_time = data['timeinfo']['ordtime'][0]['time']
+
+    logger.info('get_order_time - end', extra=sampled)
+    return order_time
+
+
+def insert_coupon_to_cart(token, dish_id, dish_price):
+    """
+    Inserts a coupon item with specific dish ID and price into the user's shopping cart.
+
+    Args:
+        token (str): A user authentication token obtained through login.
+        dish_id (int): The unique dish ID of the coupon item to be added to the cart.
+        dish_price (float): The price of the coupon item.
+
+    Returns:
+        bool: True if the coupon item is successfully inserted into the cart, False otherwise.
+    """
+    logger.info('insert_coupon_to_cart of value: %s - start', dish_price, extra=sampled)
+
+    conn = create_connection(cibus_url)
+
+    headers = {
+        'authority': cibus_authority_header,
+        'accept': cibus_accept_header,
+        'accept-language': cibus_accept_language_header,
+        'application-id': cibus_application_id_header,
+        'content-type': cibus_content_type_header,
+        'cookie': f'token={token}'
+    }
+
+    payload = {
+        'type': 'prx_add_prod_to_cart',
+        'order_type': order_type,
+        'dish_list': {
+            'category_id': category_id,
+            'dish_id': dish_id,
+            'dish_price': dish_price,
+            'co_owner_id': -1,
+            'extra_list': []
+        }
+    }
+    payload = convert_json_to_string(payload)
+
+    conn.request('POST', '/api/main.py', payload, headers)
+    res = conn.getresponse()
+
+    if not(200 <= res.status <= 299):
+        logger.error('insert_coupon_to_cart, response: %s', res.status)
+        logger.error('insert_coupon_to_cart - failed')
+        return False
+
+    data = json.loads(res.read().decode('utf-8'))
+
+    if data['code'] != 0:
+        logger.error('insert_coupon_to_cart, response: %s', data['msg'])
+        logger.error('insert_coupon_to_cart - failed')
+        return False
+
+    logger.info('insert_coupon_to_cart of value: %s - end', dish_price, extra=sampled)
+
+    return True
+
+
+def insert_coupons_to_cart(token, order_time, dishes, depth):
+    """
+    Inserts several coupon items into the user's shopping cart, with up to depth insert requests in flight at once,
+    and validates the cart contents once, with a simulated order.
+
+    Args:
+        token (str): A user authentication token obtained through login.
+        order_time (str): The desired order time, formatted as "HH:mm".
+        dishes (list): The (dish ID, dish price) of each coupon item to insert.
+        depth (int): The maximal number of insert requests in flight.
+
+    Returns:
+        tuple: Whether each coupon item is inserted (list), and the number of items in the cart (int), or None if it
+            can't be simulated.
+    """
+    import concurrent.futures
+
+    def insert(dish_id, dish_price):
+        with CibusLogging.log_context(coupon=str(dish_price)):
+            return insert_coupon_to_cart(token, dish_id, dish_price)
+
+    with concurrent.futures.ThreadPoolExecutor(min(depth, len(dishes))) as executor:
+        # the inserts run in the log context of the caller, for the correlation fields
+        futures = [executor.submit(contextvars.copy_context().run, insert, dish_id, dish_price)
+                   for dish_id, dish_price in dishes]
+        inserted = [future.result() for future in futures]
+
+    return inserted, get_cart_count(token, order_time)
+
+
+def get_cart_count(token, order_time):
+    """
+    Counts the coupon items in the user's cart, with a simulated order.
+
+    Args:
+        token (str): A user authentication token obtained through login.
+        order_time (str): The desired order time, formatted as "HH:mm".
+
+    Returns:
+        int: The number of items in the cart for the simulated order, or None if the simulation failed.
+    """
+    logger.info('get_cart_count - start')
+
+    conn = create_connection(cibus_url)
+
+    headers = {
+        'authority': cibus_authority_header,
+        'accept': 'application.json, text/plain, */*',
+        'accept-language': cibus_accept_language_header,
+        'application-id': cibus_application_id_header,
+        'content-type': cibus_content_type_header,
+        'cookie': f'token={token}'
+    }
+
+    payload = {
+        'type': 'prx_simulate_order',
+        'order_time': order_time
+    }
+
+    payload = convert_json_to_string(payload)
+
+    conn.request('POST', '/api/main.py', payload, headers)
+    res = conn.getresponse()
+
+    if not(200 <= res.status <= 299):
+        logger.error('get_cart_count, response: %s', res.status)
+        logger.error('get_cart_count - failed')
+        return None
+
+    data = json.loads(res.read().decode('utf-8'))
+
+    logger.info('get_cart_count - end')
+
+    return data['head']['count']
+
+
+def validate_coupon_inserted_to_cart(token, order_time, expected_count=1):
+    """
+    Validates whether a coupon is successfully inserted into the user's cart for a simulated order.
+
+    Args:
+        token (str): A user authentication token obtained through login.
+        order_time (str): The desired order time, formatted as "HH:mm".
+        expected_count (int): The number of coupon items the cart should hold.
+
+    Returns:
+        bool: True if the cart holds the expected number of coupon items for the simulated order, False otherwise.
+    """
+    cart_count = get_cart_count(token, order_time)
+    if cart_count != expected_count:
+        logger.error('validate_coupon_inserted_to_cart, cart count: %s, expected: %s', cart_count, expected_count)
+        return False
+    return True
+
+
+def purchase_coupon(token, user_id, order_time):
+    """
+    Simulates the purchase of a coupon for a specific user and order time.
+
+    Args:
+        token (str): A user authentication token obtained through login.
+        user_id (int): The user's identifier.
+        order_time (str): The desired order time, formatted as "HH:mm".
+
+    Returns:
+        bool: True if the coupon purchase is successfully simulated, False otherwise.
+    """
+    logger.info('purchase_coupon - start', extra=sampled)
+
+    conn = create_connection(cibus_url)
+
+    headers = {
+        'authority': cibus_authority_header,
+        'accept': cibus_accept_header,
+        'accept-language': cibus_accept_language_header,
+        'application-id': cibus_application_id_header,
+        'content-type': cibus_content_type_header,
+        'cookie': f'token={token}'
+    }
+
+    payload = {
+        'type': 'prx_apply_order',
+        'order_time': order_time
+    }
+    payload = convert_json_to_string(payload)
+
+    conn.request('POST', '/api/main.py', payload, headers)
+    res = conn.getresponse()
+    data = json.loads(res.read().decode('utf-8'))
+
+    # if data['head']['count'] != 1 or data['head']['user_id'] != user_id:
+    #     return False
+
+    logger.info('purchase_coupon - end', extra=sampled)
+
+    return True
+
+
+def fill_cart_pipelined(user_name, password, coupons, coupon_values, batch_indices, cart_pipeline_depth):
+    """
+    Logs in and fills the cart with a batch of the plan coupons, with up to cart_pipeline_depth inserts in flight,
+    and counts the cart once with a simulated order.
+    If the server rejects some of the inserts, the inserted coupons are to be checked out, and the rest inserted one
+    by one (where an out of stock coupon value switches plans). If the cart doesn't hold exactly the inserted coupons
+    (the server lost concurrent mutations, or the cart held other items), its contents are unknown - the cart is to
+    be checked out as is, and the rest of the purchase planned again from the remaining budget, see replan_purchase.
+
+    Args:
+        user_name (str): The username of the user.
+        password (str): The password of the user.
+        coupons (dict): The dish ID of each coupon value.
+        coupon_values (list): The coupon values, in the plan order.
+        batch_indices (list): The coupon value index of each coupon to insert, see get_next_coupon_indices.
+        cart_pipeline_depth (int): The maximal number of insert requests in flight.
+
+    Returns:
+        CartFill: The session, the coupon value index of each coupon in the cart, the depth to continue with (1 to
+            fall back to sequential inserts), and whether the cart contents are unknown.
+    """
+    with profile_phase('auth'):
+        token = get_user_token(user_name, password, cibus_company)
+
+    with profile_phase('cart'):
+        order_time = get_order_time(token)
+
+        dishes = [(coupons[coupon_values[k]], coupon_values[k]) for k in batch_indices]
+        inserted, cart_count = insert_coupons_to_cart(token, order_time, dishes, cart_pipeline_depth)
+    cart_indices = [k for k, is_inserted in zip(batch_indices, inserted) if is_inserted]
+    logger.info('coupons insert to card, values: %s - %s of %s inserted', [coupon_values[k] for k in batch_indices],
+                len(cart_indices), len(batch_indices))
+
+    if cart_count != len(cart_indices):
+        # an empty cart is known, its coupons are inserted again one by one
+        logger.warning('Cibus Purchase Flow - the cart holds %s items instead of the %s inserted coupons, falling '
+                       'back to sequential inserts', cart_count, len(cart_indices))
+        return CartFill(token, order_time, [], 1, cart_count != 0)
+
+    if len(cart_indices) < len(batch_indices):
+        logger.warning('Cibus Purchase Flow - %s of %s pipelined cart inserts were rejected, falling back to '
+                       'sequential inserts', len(batch_indices) - len(cart_indices), len(batch_indices))
+        cart_pipeline_depth = 1
+
+    return CartFill(token, order_time, cart_indices, cart_pipeline_depth, False)
+
+
+def check_out_cart(cart_fill, user_id, coupon_values):
+    """
+    Checks out a cart filled by fill_cart_pipelined.
+
+    Args:
+        cart_fill (CartFill): The filled cart.
+        user_id (int): The user's identifier.
+        coupon_values (list): The coupon values, in the plan order.
+
+    Returns:
+        bool: True if the cart is purchased, False otherwise.
+    """
+    with profile_phase('checkout'):
+        is_purchased = purchase_coupon(cart_fill.token, user_id, cart_fill.order_time)
+
+    cart_values = 'unknown' if cart_fill.is_cart_unknown else [coupon_values[k] for k in cart_fill.cart_indices]
+    if is_purchased:
+        logger.info('coupons purchased, values: %s - success', cart_values)
+    else:
+        logger.error('coupons purchased, values: %s - failed', cart_values)
+    return is_purchased
+
+
+def replan_purchase(token, coupon_values, solver_policy=None):
+    """
+    Plans the rest of the purchase again from the remaining budget, after a cart of unknown contents is checked out.
+
+    Args:
+        token (str): A user authentication token obtained through login.
+        coupon_values (list): The coupon values.
+        solver_policy (str | SolverPolicy): The account's solver policy, see get_solver_policy.
+
+    Returns:
+        list: The ranked plans of the remaining budget, as returned by solve_coupon_combinations.
+    """
+    _, user_budget = get_user_data(token)
+    logger.info('Cibus Purchase Flow - replanning, remaining budget: %s', user_budget)
+    with profile_phase('solve'):
+        return solve_coupon_combinations(coupon_values, int(user_budget), solver_policy, fallback_plans_count + 1,
+                                         diverse_plans=True)
+
+
+def profile_cibus_coupons_auto_purchase(profile_dir, user_name, password, solver_policy=None, lease=None):
+    """
+    Runs the purchase flow under cProfile and tracemalloc, and dumps into the profile directory:
+    <run>.prof - the cProfile stats, for pstats or snakeviz.
+    <run>.txt - the cProfile stats sorted by cumulative time.
+    <run>.json - the wall-clock duration of each phase, and the tracemalloc peak and top allocations.
+    The run files are named by the time and the run id. Only one run is profiled at a time - a run that starts while
+    another is profiled runs without profiling.
+
+    Args:
+        profile_dir (str): The directory to dump the profile files into.
+        user_name (str): The username of the user.
+        password (str): The password of the user.
+        solver_policy (str | SolverPolicy): The account's solver policy, see get_solver_policy.
+        lease (CibusAccountLease.AccountLease): The held account lease, or None.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        logger.warning('Cibus Purchase Flow - another run is profiled, running without profiling')
+        run_cibus_coupons_auto_purchase(user_name, password, solver_policy, lease)
+        return
+
+    try:
+        _profile_purchase_flow(profile_dir, user_name, password, solver_policy, lease)
+    finally:
+        _profile_lock.release()
+
+
+def _profile_purchase_flow(profile_dir, user_name, password, solver_policy, lease):
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    os.makedirs(profile_dir, exist_ok=True)
+    run_id = CibusLogging.get_log_context().get('run_id') or CibusLogging.new_run_id()
+    run_path = os.path.join(profile_dir, f'cibus_profile_{datetime.now():%Y%m%d_%H%M%S}_{run_id}')
+
+    phase_durations = {}
+    phase_durations_token = _profile_phase_durations.set(phase_durations)
+    profiler = cProfile.Profile()
+    is_tracing = tracemalloc.is_tracing()  # e.g. the load test traces the memory itself
+    if not is_tracing:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        profiler.runcall(run_cibus_coupons_auto_purchase, user_name, password, solver_policy, lease)
+    finally:
+        total_duration = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        top_allocations = tracemalloc.take_snapshot().statistics('lineno')[:profile_top_allocations_count]
+        if not is_tracing:
+            tracemalloc.stop()
+        _profile_phase_durations.reset(phase_durations_token)
+
+        profiler.dump_stats(f'{run_path}.prof')
+        with open(f'{run_path}.txt', 'w') as stats_file:
+            pstats.Stats(profiler, stream=stats_file).sort_stats('cumulative').print_stats()
+
+        summary = {
+            'total_duration': total_duration,
+            'phase_durations': phase_durations,
+            'peak_memory': peak_memory,
+            'top_allocations': [{'location': str(allocation.traceback), 'size': allocation.size,
+                                 'count': allocation.count} for allocation in top_allocations],
+        }
+        with open(f'{run_path}.json', 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2)
+
+        logger.info('Cibus Purchase Flow - profile dumped to %s.*, phases: %s', run_path, phase_durations)
+
+
+def cibus_coupons_auto_purchase(user_name, password, solver_policy=None, lease_store=None):
+    """
+    Purchases the best combination of coupons for the user's budget, profiled if the profile directory
+    environment variable is set. With a lease store, the account is skipped if another worker processes it.
+
+    Args:
+        user_name (str): The username of the user.
+        password (str): The password of the user.
+        solver_policy (str | SolverPolicy): The account's solver policy, see get_solver_policy.
+        lease_store: The account lease store, see CibusAccountLease, or None to run without a lease.
+    """
+    with CibusLogging.log_context(run_id=CibusLogging.new_run_id(), account=CibusLogging.get_account_tag(user_name)):
+        if lease_store is None:
+            _purchase_flow(user_name, password, solver_policy)
+            return
+
+        import CibusAccountLease
+
+        with CibusAccountLease.account_lease(lease_store, user_name) as lease:
+            if lease is None:
+                logger.info('Cibus Purchase Flow - the account is processed by another worker, skipped')
+                return
+            _purchase_flow(user_name, password, solver_policy, lease)
+
+
+def _purchase_flow(user_name, password, solver_policy, lease=None):
+    profile_dir = os.environ.get(profile_dir_environment_variable)
+    if profile_dir:
+        profile_cibus_coupons_auto_purchase(profile_dir, user_name, password, solver_policy, lease)
+    else:
+        run_cibus_coupons_auto_purchase(user_name, password, solver_policy, lease)
+
+
+def run_cibus_coupons_auto_purchase(user_name, password, solver_policy=None, lease=None):
+    """
+    Purchases the best combination of coupons for the user's budget.
+
+    Args:
+        user_name (str): The username of the user.
+        password (str): The password of the user.
+        solver_policy (str | SolverPolicy): The account's solver policy, see get_solver_policy.
+        lease (CibusAccountLease.AccountLease): The held account lease, the purchase stops if it's lost.
+    """
+    company = cibus_company
+
+    logger.info('Cibus Purchase Flow - Start')
+
+    with profile_phase('auth'):
+        token = get_user_token(user_name, password, company)
+
+    with profile_phase('user_info'):
+        user_id, user_budget = get_user_data(token)
+
+    logger.info('Cibus Purchase Flow - User Budget: %s', user_budget)
+
+    with profile_phase('menu'):
+        coupons = get_available_coupons(token)
+
+    coupon_values = list(coupons.keys())
+
+    with profile_phase('solve'):
+        purchase_plans = solve_coupon_combinations(coupon_values, int(user_budget), solver_policy,
+                                                   fallback_plans_count + 1, diverse_plans=True)
+    if not purchase_plans:
+        logger.error('Cibus Purchase Flow - no coupons combination satisfies the solver policy')
+        return
+
+    plan_index = 0
+    handled_combination = [0] * len(coupon_values)
+    failed_indices = set()
+    cart_pipeline_depth = get_cart_pipeline_depth()
+
+    while True:
+        best_coupons_combination, _ = purchase_plans[plan_index]
+        i = get_next_coupon_index(best_coupons_combination, handled_combination)
+        if i is None:
+            break
+
+        if lease is not None and lease.lost:
+            logger.error('Cibus Purchase Flow - the account lease is lost, stopping')
+            break
+
+        batch_indices = get_next_coupon_indices(best_coupons_combination, handled_combination, cart_pipeline_depth)
+        if len(batch_indices) > 1:
+            cart_fill = fill_cart_pipelined(user_name, password, coupons, coupon_values, batch_indices,
+                                            cart_pipeline_depth)
+            cart_pipeline_depth = cart_fill.cart_pipeline_depth
+            if cart_fill.cart_indices or cart_fill.is_cart_unknown:
+                check_out_cart(cart_fill, user_id, coupon_values)
+
+            if cart_fill.is_cart_unknown:
+                purchase_plans = replan_purchase(cart_fill.token, coupon_values, solver_policy)
+                if not purchase_plans:
+                    logger.info('Cibus Purchase Flow - no coupons combination for the remaining budget')
+                    break
+                plan_index = 0
+                handled_combination = [0] * len(coupon_values)
+                failed_indices = set()
+
+            for k in cart_fill.cart_indices:
+                handled_combination[k] += 1
+            continue
+
+        purchase_times = int(best_coupons_combination[i])
+        j = handled_combination[i]
+        coupon_value = coupon_values[i]
+        dish_id = coupons[coupon_value]
+
+        with CibusLogging.log_context(coupon=f'{coupon_value}#{j + 1}'):
+            with profile_phase('auth'):
+                token = get_user_token(user_name, password, company)
+
+            with profile_phase('cart'):
+                order_time = get_order_time(token)
+
+                is_inserted_to_cart = insert_coupon_to_cart(token, dish_id, coupon_value)
+            # is_inserted_to_cart = is_inserted_to_cart and validate_coupon_inserted_to_cart(token, order_time)
+            logger.info('coupon insert to card, value: %s, %s of %s times - %s', coupon_value, j + 1, purchase_times,
+                        'success' if is_inserted_to_cart else 'failed', extra=sampled)
+
+            if not is_inserted_to_cart:
+                failed_indices.add(i)
+                plan_index = get_fallback_plan_index(purchase_plans, plan_index, handled_combination, failed_indices)
+                if plan_index is None:
+                    logger.error('Cibus Purchase Flow - no fallback plan without coupon value: %s', coupon_value)
+                    break
+                logger.info('Cibus Purchase Flow - switched to fallback plan %s: %s', plan_index,
+                            purchase_plans[plan_index])
+                continue
+
+            with profile_phase('checkout'):
+                is_coupon_purchased = purchase_coupon(token, user_id, order_time)
+            if is_coupon_purchased:
+                logger.info('coupon purchased, value: %s, %s of %s times - success', coupon_value, j + 1,
+                            purchase_times, extra=sampled)
+            else:
+                logger.error('coupon purchased, value: %s, %s of %s times - failed', coupon_value, j + 1,
+                             purchase_times)
+            handled_combination[i] += 1
+
+    logger.info('Cibus Purchase Flow - End')
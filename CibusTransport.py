@@ -0,0 +1,353 @@
+import http.client
+import os
+import threading
+import zlib
+
+# The transports of the Cibus connections, selected by the CIBUS_TRANSPORT app setting:
+# http1 - a new http.client HTTPS connection per request, uncompressed (the default).
+# compressed - http.client HTTPS connections that negotiate gzip (and br, if brotli is installed) and decompress the
+#   responses while reading them.
+# http2 - a shared httpx client per host, that multiplexes the concurrent requests of all the accounts over a few
+#   HTTP/2 connections, with compression (requires httpx[http2], and brotli for br).
+transport_environment_variable = 'CIBUS_TRANSPORT'
+transports = ('http1', 'compressed', 'http2')
+default_transport = 'http1'
+
+# The maximal connections of the http2 transport to every host, set by the CIBUS_HTTP2_CONNECTIONS app setting
+http2_connections_environment_variable = 'CIBUS_HTTP2_CONNECTIONS'
+default_http2_connections_per_host = 4
+
+read_chunk_size = 64 * 1024
+
+
+class TransferStats:
+    """
+    Counts the response bytes received on the wire and after decompression, over all the connections.
+    """
+
+    def __init__(self):
+        self.responses = 0
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        self.http_versions = {}  # the number of responses of each negotiated HTTP version
+        self._lock = threading.Lock()
+
+    def add(self, wire_bytes, decoded_bytes, http_version='HTTP/1.1'):
+        with self._lock:
+            self.responses += 1
+            self.wire_bytes += wire_bytes
+            self.decoded_bytes += decoded_bytes
+            self.http_versions[http_version] = self.http_versions.get(http_version, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self.responses = self.wire_bytes = self.decoded_bytes = 0
+            self.http_versions = {}
+
+
+transfer_stats = TransferStats()
+
+
+def get_accept_encoding():
+    """
+    Returns:
+        str: The content encodings this client can decompress, for the Accept-Encoding header.
+    """
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        return 'gzip, deflate'
+    return 'gzip, deflate, br'
+
+
+class DeflateDecompressor:
+    """
+    Decompresses a deflate response - zlib framed as the standard requires, or raw deflate as some servers send it,
+    told apart by the zlib header of the first two bytes.
+    """
+
+    def __init__(self):
+        self._decompressor = None
+        self._head = b''
+
+    def decompress(self, chunk):
+        if self._decompressor is None:
+            self._head += chunk
+            if len(self._head) < 2:
+                return b''
+            is_zlib_framed = self._head[0] & 0x0f == 8 and int.from_bytes(self._head[:2], 'big') % 31 == 0
+            self._decompressor = zlib.decompressobj(zlib.MAX_WBITS if is_zlib_framed else -zlib.MAX_WBITS)
+            chunk, self._head = self._head, b''
+        return self._decompressor.decompress(chunk)
+
+    def flush(self):
+        if self._decompressor is None:
+            # a body shorter than a zlib header can only be raw deflate
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decompressor.decompress(self._head) + self._decompressor.flush()
+        return self._decompressor.flush()
+
+
+def _create_coding_decompressor(content_coding):
+    if content_coding in ('gzip', 'x-gzip'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return decompressor.decompress, decompressor.flush
+
+    if content_coding == 'deflate':
+        decompressor = DeflateDecompressor()
+        return decompressor.decompress, decompressor.flush
+
+    if content_coding == 'br':
+        try:
+            import brotli
+        except ImportError:
+            raise ValueError('the response is brotli compressed, but brotli is not installed') from None
+        decompressor = brotli.Decompressor()
+        return decompressor.process, bytes
+
+    raise ValueError(f'unsupported content encoding: {content_coding}')
+
+
+def create_decompressor(content_encoding):
+    """
+    Creates a streaming decompressor of a response content encoding. The codings of a multi-coding encoding (e.g.
+    "gzip, br") are decoded in the reverse order they were applied.
+
+    Args:
+        content_encoding (str): The Content-Encoding header value, or None.
+
+    Returns:
+        tuple: The decompress(chunk) and flush() functions, returning the decompressed bytes, or None for identity.
+
+    Raises:
+        ValueError: If a content coding isn't supported.
+    """
+    content_codings = [coding.strip().lower() for coding in (content_encoding or '').split(',')]
+    decompressors = [_create_coding_decompressor(coding) for coding in reversed(content_codings)
+                     if coding not in ('', 'identity')]
+    if not decompressors:
+        return None
+    if len(decompressors) == 1:
+        return decompressors[0]
+
+    def decompress(chunk):
+        for coding_decompress, _ in decompressors:
+            chunk = coding_decompress(chunk)
+        return chunk
+
+    def flush():
+        # every coding flushes its remaining output through the codings after it
+        data = b''
+        for coding_decompress, coding_flush in decompressors:
+            data = (coding_decompress(data) if data else b'') + coding_flush()
+        return data
+
+    return decompress, flush
+
+
+class DecompressedResponse:
+    """
+    An HTTP response, decompressed chunk by chunk as it's read, with the parts of the http.client.HTTPResponse
+    interface used by the purchase flow.
+    """
+
+    def __init__(self, response):
+        self.status = response.status
+        self.reason = response.reason
+        self._response = response
+        self._body = None
+
+    def getheader(self, name, default=None):
+        if name.lower() in ('content-encoding', 'content-length'):
+            return default
+        return self._response.getheader(name, default)
+
+    def getheaders(self):
+        return [(name, value) for name, value in self._response.getheaders()
+                if name.lower() not in ('content-encoding', 'content-length')]
+
+    def read(self):
+        if self._body is not None:
+            return self._body
+
+        decompressor = create_decompressor(self._response.getheader('content-encoding'))
+        decompress, flush = decompressor or (None, None)
+        chunks = []
+        wire_bytes = 0
+        while True:
+            chunk = self._response.read(read_chunk_size)
+            if not chunk:
+                break
+            wire_bytes += len(chunk)
+            chunks.append(decompress(chunk) if decompress else chunk)
+        if flush:
+            chunks.append(flush())
+
+        self._body = b''.join(chunks)
+        transfer_stats.add(wire_bytes, len(self._body))
+        return self._body
+
+
+class CompressedHTTPSConnection(http.client.HTTPSConnection):
+    """
+    An http.client HTTPS connection that negotiates compressed responses.
+    """
+
+    def request(self, method, url, body=None, headers=None, **kwargs):
+        headers = dict(headers or {})
+        if not any(name.lower() == 'accept-encoding' for name in headers):
+            headers['accept-encoding'] = get_accept_encoding()
+        super().request(method, url, body, headers, **kwargs)
+
+    def getresponse(self):
+        return DecompressedResponse(super().getresponse())
+
+
+class Http2Response:
+    """
+    An httpx response, decompressed by httpx, with the parts of the http.client.HTTPResponse interface used by the
+    purchase flow.
+    """
+
+    def __init__(self, response):
+        self.status = response.status_code
+        self.reason = response.reason_phrase
+        self.http_version = response.http_version
+        self._response = response
+
+    def getheader(self, name, default=None):
+        if name.lower() in ('content-encoding', 'content-length'):
+            return default
+        return self._response.headers.get(name, default)
+
+    def getheaders(self):
+        return [(name, value) for name, value in self._response.headers.items()
+                if name.lower() not in ('content-encoding', 'content-length')]
+
+    def read(self):
+        return self._response.content
+
+
+class Http2Connection:
+    """
+    A connection-like view of a shared httpx client - every request goes through the client connection pool, which
+    multiplexes the concurrent requests over a few HTTP/2 connections, and decompresses the responses.
+
+    While a host isn't known to negotiate HTTP/2, its in-flight requests are limited to its connections, so they never
+    wait for the pool - httpcore may close an idle connection that was just handed to a waiting request, and over
+    HTTP/1.1 every request needs a connection of its own.
+    """
+
+    _clients = {}
+    _clients_lock = threading.Lock()
+
+    def __init__(self, host, port=None, context=None):
+        """
+        Args:
+            host (str): The host to connect to.
+            port (int): The port to connect to, 443 by default.
+            context (ssl.SSLContext): The client TLS context, the default verification by default.
+        """
+        self.base_url = f'https://{host}:{port or 443}'
+        self.context = context
+        self._request = None
+
+    @classmethod
+    def get_client(cls, base_url, context=None):
+        """
+        Returns the shared httpx client of a host, created on first use.
+
+        Returns:
+            tuple: The httpx.Client, and the semaphore of its in-flight requests while it isn't known to negotiate
+                HTTP/2, or None once it is.
+        """
+        import httpx
+
+        with cls._clients_lock:
+            client = cls._clients.get(base_url)
+            if client is None:
+                connections = get_http2_connections_per_host()
+                # no timeout, as the http.client transports, so a slow evening peak response isn't an error
+                client = cls._clients[base_url] = [httpx.Client(
+                    base_url=base_url, http2=True, verify=context if context is not None else True, timeout=None,
+                    limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+                    headers={'accept-encoding': get_accept_encoding()}), threading.Semaphore(connections)]
+            return tuple(client)
+
+    @classmethod
+    def close_clients(cls):
+        with cls._clients_lock:
+            for client, _ in cls._clients.values():
+                client.close()
+            cls._clients = {}
+
+    def request(self, method, url, body=None, headers=None):
+        self._request = (method, url, body, headers or {})
+
+    def getresponse(self):
+        method, url, body, headers = self._request
+        client, requests_semaphore = self.get_client(self.base_url, self.context)
+        content = body.encode('utf-8') if isinstance(body, str) else body
+        if requests_semaphore is None:
+            response = client.request(method, url, content=content, headers=headers)
+        else:
+            with requests_semaphore:
+                response = client.request(method, url, content=content, headers=headers)
+            if response.http_version == 'HTTP/2':
+                with self._clients_lock:
+                    self._clients.get(self.base_url, [None, None])[1] = None
+        transfer_stats.add(response.num_bytes_downloaded, len(response.content), response.http_version)
+        return Http2Response(response)
+
+    def close(self):
+        pass
+
+
+def get_http2_connections_per_host():
+    """
+    Returns:
+        int: The maximal connections of the http2 transport to every host, from the CIBUS_HTTP2_CONNECTIONS app
+            setting.
+
+    Raises:
+        ValueError: If the configured connections count isn't a positive integer.
+    """
+    connections = int(os.environ.get(http2_connections_environment_variable, default_http2_connections_per_host))
+    if connections < 1:
+        raise ValueError(f'{http2_connections_environment_variable} must be positive, got: {connections}')
+    return connections
+
+
+def get_transport():
+    """
+    Returns:
+        str: The configured transport, from the CIBUS_TRANSPORT app setting.
+
+    Raises:
+        ValueError: If the configured transport is unknown.
+    """
+    transport = os.environ.get(transport_environment_variable, default_transport)
+    if transport not in transports:
+        raise ValueError(f'unknown {transport_environment_variable}: {transport}, expected one of {transports}')
+    return transport
+
+
+def create_connection(host, port=None, context=None, transport=None):
+    """
+    Opens a connection to a Cibus host over the transport.
+
+    Args:
+        host (str): The host to connect to.
+        port (int): The port to connect to, 443 by default.
+        context (ssl.SSLContext): The client TLS context, the default verification by default.
+        transport (str): The transport, see transports, the configured transport by default.
+
+    Returns:
+        object: A connection with the http.client.HTTPSConnection request and getresponse methods.
+    """
+    transport = transport or get_transport()
+    if transport == 'http2':
+        return Http2Connection(host, port, context)
+    if transport == 'compressed':
+        return CompressedHTTPSConnection(host, port, context=context)
+    return http.client.HTTPSConnection(host, port, context=context)
@@ -0,0 +1,232 @@
+import http.client
+import json
+import threading
+import time
+
+scrubbed_value = '<SCRUBBED>'
+scrubbed_json_keys = {'username', 'password', 'company', 'token'}
+scrubbed_headers = {'cookie', 'set-cookie', 'authorization'}
+
+
+def scrub_body(body):
+    """
+    Replaces the credentials and tokens in a JSON request or response body.
+
+    Args:
+        body (str): The body, bodies that aren't JSON are returned as is.
+
+    Returns:
+        str: The scrubbed body.
+    """
+    if not body:
+        return body
+
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return body
+
+    def scrub(item):
+        if isinstance(item, dict):
+            return {key: scrubbed_value if key in scrubbed_json_keys else scrub(value) for key, value in item.items()}
+        if isinstance(item, list):
+            return [scrub(value) for value in item]
+        return item
+
+    return json.dumps(scrub(data), ensure_ascii=False)
+
+
+def scrub_headers(headers):
+    """
+    Replaces the credentials and tokens in HTTP headers.
+
+    Args:
+        headers (dict): The headers by name.
+
+    Returns:
+        dict: The scrubbed headers.
+    """
+    return {name: scrubbed_value if name.lower() in scrubbed_headers else value for name, value in headers.items()}
+
+
+class Cassette:
+    """
+    A recorded sequence of HTTP exchanges (interactions), saved as a JSON file.
+    """
+
+    def __init__(self, interactions=None):
+        self.interactions = interactions or []
+        self._lock = threading.Lock()
+        self._replayed = set()
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as cassette_file:
+            return cls(json.load(cassette_file)['interactions'])
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as cassette_file:
+            json.dump({'interactions': self.interactions}, cassette_file, ensure_ascii=False, indent=2)
+
+    def record(self, interaction):
+        with self._lock:
+            self.interactions.append(interaction)
+
+    def rewind(self):
+        """
+        Makes all the interactions available for replay again.
+        """
+        with self._lock:
+            self._replayed.clear()
+
+    def match(self, host, method, url, body):
+        """
+        Finds the interaction to replay for a request - the first not yet replayed interaction with the same
+        request, preferring the same scrubbed body. Once all the matching interactions are replayed, the last one
+        is replayed again.
+
+        Args:
+            host (str): The request host.
+            method (str): The request method.
+            url (str): The request URL.
+            body (str): The scrubbed request body.
+
+        Returns:
+            dict: The interaction.
+
+        Raises:
+            LookupError: If the cassette has no interaction for the request.
+        """
+        with self._lock:
+            candidates = [(index, interaction) for index, interaction in enumerate(self.interactions)
+                          if (interaction['host'], interaction['method'], interaction['url']) == (host, method, url)]
+            same_body = [(index, interaction) for index, interaction in candidates if interaction['body'] == body]
+            candidates = same_body or candidates
+            if not candidates:
+                raise LookupError(f'no cassette interaction for {method} {host}{url}')
+
+            index, interaction = next(((index, interaction) for index, interaction in candidates
+                                       if index not in self._replayed), candidates[-1])
+            self._replayed.add(index)
+            return interaction
+
+
+class CassetteResponse:
+    """
+    A recorded response, with the parts of the http.client.HTTPResponse interface used by the purchase flow.
+    """
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._body = body.encode('utf-8')
+
+    def read(self):
+        return self._body
+
+    def getheader(self, name, default=None):
+        return next((value for header, value in self.headers.items() if header.lower() == name.lower()), default)
+
+    def getheaders(self):
+        return list(self.headers.items())
+
+
+class RecordingConnection:
+    """
+    An HTTPS connection that records its exchanges into a cassette, with the credentials and tokens scrubbed.
+    """
+
+    def __init__(self, host, cassette):
+        self.host = host
+        self.cassette = cassette
+        self._connection = http.client.HTTPSConnection(host)
+        self._request = None
+
+    def request(self, method, url, body=None, headers=None):
+        headers = headers or {}
+        self._request = {
+            'host': self.host,
+            'method': method,
+            'url': url,
+            'headers': scrub_headers(headers),
+            'body': scrub_body(body),
+            'started': time.perf_counter(),
+        }
+        self._connection.request(method, url, body, headers)
+
+    def getresponse(self):
+        response = self._connection.getresponse()
+        body = response.read().decode('utf-8')
+        request = self._request
+        self.cassette.record({
+            'host': request['host'],
+            'method': request['method'],
+            'url': request['url'],
+            'headers': request['headers'],
+            'body': request['body'],
+            'response': {
+                'status': response.status,
+                'reason': response.reason,
+                'headers': scrub_headers(dict(response.getheaders())),
+                'body': scrub_body(body),
+            },
+            'latency': time.perf_counter() - request['started'],
+        })
+        return CassetteResponse(response.status, response.reason, dict(response.getheaders()), body)
+
+    def close(self):
+        self._connection.close()
+
+
+class ReplayConnection:
+    """
+    A connection that serves the exchanges of a cassette, at the recorded latencies times the latency scale.
+    """
+
+    def __init__(self, host, cassette, latency_scale=1.0):
+        self.host = host
+        self.cassette = cassette
+        self.latency_scale = latency_scale
+        self._interaction = None
+
+    def request(self, method, url, body=None, headers=None):
+        self._interaction = self.cassette.match(self.host, method, url, scrub_body(body))
+
+    def getresponse(self):
+        interaction = self._interaction
+        if self.latency_scale > 0:
+            time.sleep(interaction['latency'] * self.latency_scale)
+        response = interaction['response']
+        return CassetteResponse(response['status'], response['reason'], response['headers'], response['body'])
+
+    def close(self):
+        pass
+
+
+def recording_connection_factory(cassette):
+    """
+    Creates a connection factory, for CibusPurchaseEngine.connection_factory, that records into a cassette.
+
+    Args:
+        cassette (Cassette): The cassette to record into.
+
+    Returns:
+        function: The connection factory.
+    """
+    return lambda host: RecordingConnection(host, cassette)
+
+
+def replay_connection_factory(cassette, latency_scale=1.0):
+    """
+    Creates a connection factory, for CibusPurchaseEngine.connection_factory, that replays a cassette.
+
+    Args:
+        cassette (Cassette): The cassette to replay.
+        latency_scale (float): The factor of the recorded latencies, 0 to replay without latency.
+
+    Returns:
+        function: The connection factory.
+    """
+    return lambda host: ReplayConnection(host, cassette, latency_scale)
+
@@ -0,0 +1,171 @@
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+debug_locally_dir = os.path.join(repository_dir, 'DebugLocally')
+# a stand-in azure.functions package, imported instead of azure-functions where it isn't installed
+azure_stubs_dir = os.path.join(debug_locally_dir, 'stubs')
+
+# (entry point name, module, directory to import it from, modules it must not import)
+entry_points = [
+    ('engine', 'CibusPurchaseEngine', repository_dir,
+     ['azure.functions', 'http.client', 'ssl', 'cProfile', 'tracemalloc', 'CibusAccountLease', 'sqlite3',
+      'logging.handlers', 'CibusTransport', 'httpx']),
+    ('azure', 'CibusCouponsAutoPurchase', repository_dir,
+     ['CibusPurchaseEngine', 'CibusAccountLease', 'CibusPipeline', 'azure.storage.blob', 'http.client', 'ssl',
+      'cProfile', 'tracemalloc']),
+    ('local', 'CibusCouponsAutoPurchase', debug_locally_dir,
+     ['azure.functions', 'CibusPurchaseEngine', 'http.client', 'ssl', 'cProfile', 'tracemalloc']),
+]
+
+
+def is_azure_functions_installed():
+    """
+    Returns:
+        bool: Whether the azure-functions package is installed in this environment.
+    """
+    try:
+        return importlib.util.find_spec('azure.functions') is not None
+    except ModuleNotFoundError:
+        return False
+
+
+def measure_import_time(module, import_dir, stub_azure=False):
+    """
+    Imports a module in a fresh interpreter with -X importtime.
+
+    Args:
+        module (str): The module to import.
+        import_dir (str): The directory to import the module from.
+        stub_azure (bool): Whether to import the stand-in azure.functions package of azure_stubs_dir.
+
+    Returns:
+        dict: The cumulative import time in microseconds of every imported module, by module name.
+
+    Raises:
+        ImportError: If the module fails to import, e.g. a syntax or import error.
+    """
+    environment = dict(os.environ)
+    if stub_azure:
+        environment['PYTHONPATH'] = os.pathsep.join(filter(None, [azure_stubs_dir, environment.get('PYTHONPATH')]))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=import_dir,
+                            capture_output=True, text=True, env=environment)
+    if result.returncode != 0:
+        error = next((line for line in reversed(result.stderr.splitlines()) if not line.startswith('import time:')),
+                     f'exit code {result.returncode}')
+        raise ImportError(error)
+
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, imported_module = line[len('import time:'):].split('|')
+        import_times[imported_module.strip()] = int(cumulative)
+    return import_times
+
+
+def benchmark_entry_points(repeat, stub_azure=False):
+    """
+    Measures the import time of every entry point, the best of several fresh interpreters.
+
+    Args:
+        repeat (int): The number of imports of each entry point.
+        stub_azure (bool): Whether to import the stand-in azure.functions package instead of azure-functions.
+
+    Returns:
+        dict: The report of each entry point by name - its import time in milliseconds, and the forbidden modules
+            it imported, or its import error.
+    """
+    report = {}
+    for name, module, import_dir, forbidden_modules in entry_points:
+        try:
+            measurements = [measure_import_time(module, import_dir, stub_azure) for _ in range(repeat)]
+        except ImportError as error:
+            report[name] = {'import_error': str(error)}
+            continue
+
+        report[name] = {
+            'import_ms': min(import_times[module] for import_times in measurements) / 1000,
+            'forbidden_imports': [forbidden for forbidden in forbidden_modules if forbidden in measurements[0]],
+        }
+    return report
+
+
+def find_regressions(report, max_import_ms, baseline=None, tolerance=0.25):
+    """
+    Finds the cold-start regressions in an import time report.
+
+    Args:
+        report (dict): The report, as returned by benchmark_entry_points.
+        max_import_ms (float): The import time budget of every entry point, in milliseconds.
+        baseline (dict): A previous report to compare with, or None.
+        tolerance (float): The allowed import time growth relative to the baseline.
+
+    Returns:
+        list: The regressions descriptions.
+    """
+    regressions = []
+    for name, entry_point_report in report.items():
+        if 'import_error' in entry_point_report:
+            regressions.append(f'{name}: fails to import - {entry_point_report["import_error"]}')
+            continue
+
+        import_ms = entry_point_report['import_ms']
+        if entry_point_report['forbidden_imports']:
+            regressions.append(f'{name}: imports {", ".join(entry_point_report["forbidden_imports"])} at import time')
+        if import_ms > max_import_ms:
+            regressions.append(f'{name}: {import_ms:.1f}ms import time exceeds the {max_import_ms:.1f}ms budget')
+
+        baseline_report = (baseline or {}).get(name)
+        if baseline_report and 'import_ms' in baseline_report \
+                and import_ms > baseline_report['import_ms'] * (1 + tolerance):
+            regressions.append(f'{name}: {import_ms:.1f}ms import time regressed from '
+                               f'{baseline_report["import_ms"]:.1f}ms')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Guard the cold-start import time of the Cibus entry points.')
+    parser.add_argument('--repeat', type=int, default=5, help='the number of imports of each entry point')
+    parser.add_argument('--max-import-ms', type=float, default=100.0,
+                        help='the import time budget of every entry point, in milliseconds')
+    parser.add_argument('--baseline', metavar='REPORT', help='a previous report to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='the allowed import time growth relative to the baseline')
+    parser.add_argument('--save', metavar='REPORT', help='save the report, e.g. as a baseline')
+    parser.add_argument('--allow-missing-azure', action='store_true',
+                        help='where azure-functions isn\'t installed, import a stand-in azure.functions package '
+                             'instead of failing')
+    args = parser.parse_args()
+
+    stub_azure = not is_azure_functions_installed()
+    if stub_azure and not args.allow_missing_azure:
+        print('azure-functions isn\'t installed, so the azure entry point can\'t be imported - install it, or pass '
+              '--allow-missing-azure to import a stand-in azure.functions package')
+        sys.exit(1)
+
+    report = benchmark_entry_points(args.repeat, stub_azure)
+    for name, entry_point_report in report.items():
+        if 'import_error' in entry_point_report:
+            print(f'{name}: failed to import')
+        else:
+            print(f'{name}: {entry_point_report["import_ms"]:.1f}ms'
+                  + (' (with the stand-in azure.functions)' if stub_azure else ''))
+
+    if args.save:
+        with open(args.save, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    regressions = find_regressions(report, args.max_import_ms, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'regression - {regression}')
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,162 @@
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+from CibusStandIn import CibusStandIn, latency_profiles
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import CibusPipeline  # noqa: E402 - the purchase engine lives in the repository root
+import CibusPurchaseEngine  # noqa: E402
+
+purchase_window_minutes = 60  # the timer trigger fires from 20:00 to 21:00
+
+
+def is_account_purchased(job):
+    """
+    Checks whether an account completed its purchase - it purchased every coupon of the plan it finished on.
+
+    Args:
+        job (CibusPipeline.AccountJob): The completed account job.
+
+    Returns:
+        bool: True if the account purchased its whole plan, False otherwise.
+    """
+    if job.error is not None or not job.purchase_plans or job.plan_index is None:
+        return False
+    coupons_combination, _ = job.purchase_plans[job.plan_index]
+    return job.purchased_count == sum(int(count) for count in coupons_combination)
+
+
+def run_load_step(stand_in, roster_size, stage_settings, solve_process_workers):
+    """
+    Runs a roster of simulated accounts through the purchase pipeline against the stand-in, and then again with
+    tracemalloc to measure the memory, outside the timed run.
+
+    Args:
+        stand_in (CibusStandIn): The running Cibus stand-in.
+        roster_size (int): The number of simulated accounts.
+        stage_settings (dict): The (workers, queue size) of each stage, overriding the pipeline defaults.
+        solve_process_workers (int): The number of solver processes, or 0 to solve in threads.
+
+    Returns:
+        dict: The step results - duration, throughput, error rate, requests per account, memory and stage stats.
+    """
+    # the stand-in spends the budget of every account, so every run has its own accounts
+    accounts = [(f'load-test-{roster_size}-{index}', 'password', CibusPurchaseEngine.default_solver_policy)
+                for index in range(roster_size)]
+    memory_accounts = [(f'{user_name}-memory', password, solver_policy) for user_name, password, solver_policy in accounts]
+    pipeline = CibusPipeline.PurchasePipeline(stage_settings, solve_process_workers=solve_process_workers)
+    workers = sum(stage.workers for stage in pipeline.stages.values())
+
+    requests_count = stand_in.requests_count
+    start = time.perf_counter()
+    completed_jobs = pipeline.run(accounts)
+    duration = time.perf_counter() - start
+    requests_count = stand_in.requests_count - requests_count
+
+    tracemalloc.start()
+    CibusPipeline.PurchasePipeline(stage_settings, solve_process_workers=solve_process_workers).run(memory_accounts)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    purchased_jobs = [job for job in completed_jobs if is_account_purchased(job)]
+    return {
+        'roster_size': roster_size,
+        'duration_seconds': duration,
+        'accounts_per_minute': len(purchased_jobs) / duration * 60,
+        'error_rate': 1 - len(purchased_jobs) / len(completed_jobs),
+        'requests_per_account': requests_count / roster_size,
+        'workers': workers,
+        'peak_memory_bytes': peak_memory,
+        'memory_per_worker_bytes': peak_memory / workers,
+        'stages': pipeline.get_stats(),
+    }
+
+
+def estimate_capacity(steps, latency_scale, max_error_rate):
+    """
+    Estimates the maximal roster one instance finishes inside the purchase window, by the throughput of the largest
+    roster step within the error rate limit - smaller rosters don't load the pipeline, and overestimate it. The
+    stand-in latencies are scaled, so the throughput is scaled back by the latency scale, assuming the flow is bound
+    by the server latency rather than by CPU.
+
+    Args:
+        steps (list): The ramp step results, as returned by run_load_step.
+        latency_scale (float): The factor the stand-in latencies were scaled by.
+        max_error_rate (float): The maximal error rate of a step to count.
+
+    Returns:
+        dict: The sustained throughput (purchased accounts per minute, in real latency) and the maximal roster size,
+            or None if no step is within the error rate limit.
+    """
+    valid_steps = [step for step in steps if step['error_rate'] <= max_error_rate]
+    if not valid_steps:
+        return None
+
+    largest_step = max(valid_steps, key=lambda step: step['roster_size'])
+    accounts_per_minute = largest_step['accounts_per_minute'] * latency_scale
+    return {
+        'roster_size': largest_step['roster_size'],
+        'accounts_per_minute': accounts_per_minute,
+        'max_roster_size': math.floor(accounts_per_minute * purchase_window_minutes),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the purchase pipeline against a local Cibus stand-in, '
+                                                 'and estimate the accounts one instance can purchase for in the '
+                                                 f'{purchase_window_minutes} minutes window.')
+    parser.add_argument('--ramp', type=int, nargs='+', default=[10, 25, 50, 100, 200],
+                        help='the roster sizes to ramp through')
+    parser.add_argument('--latency-profile', choices=sorted(latency_profiles), default='typical',
+                        help='the stand-in latency profile')
+    parser.add_argument('--latency-scale', type=float, default=0.1,
+                        help='scale the stand-in latencies, to compress the test time')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='the stand-in endpoints failure probability')
+    parser.add_argument('--max-error-rate', type=float, default=0.01,
+                        help='the maximal accounts error rate of a step to count for the capacity')
+    parser.add_argument('--stage-settings', type=json.loads, default=None,
+                        help='the pipeline stage settings as JSON, e.g. \'{"cart": [16, 32]}\'')
+    parser.add_argument('--cart-pipeline-depth', type=int, default=1,
+                        help='the cart inserts in flight per account, 1 to insert and check out coupons one by one')
+    parser.add_argument('--concurrent-cart-inserts', choices=['accept', 'reject', 'lose'], default='accept',
+                        help='how the stand-in handles concurrent cart inserts of the same account')
+    parser.add_argument('--solve-processes', type=int, default=0, help='the number of solver processes')
+    parser.add_argument('--report', metavar='PATH', help='save the full report as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    stand_in = CibusStandIn(args.latency_profile, args.latency_scale, args.error_rate, seed=0,
+                            concurrent_cart_inserts=args.concurrent_cart_inserts)
+    stand_in.start()
+    os.environ[CibusPurchaseEngine.cart_pipeline_depth_environment_variable] = str(args.cart_pipeline_depth)
+    CibusPurchaseEngine.connection_factory = stand_in.connection_factory()
+
+    steps = []
+    try:
+        for roster_size in args.ramp:
+            step = run_load_step(stand_in, roster_size, args.stage_settings, args.solve_processes)
+            steps.append(step)
+            print(f'roster: {roster_size:5d}, duration: {step["duration_seconds"]:7.2f}s, '
+                  f'throughput: {step["accounts_per_minute"]:8.1f} purchased accounts/min, '
+                  f'errors: {step["error_rate"]:6.1%}, '
+                  f'memory per worker: {step["memory_per_worker_bytes"] / 1024:7.1f}KiB')
+    finally:
+        stand_in.stop()
+
+    capacity = estimate_capacity(steps, args.latency_scale, args.max_error_rate)
+    if capacity is None:
+        print(f'capacity: no ramp step within the {args.max_error_rate:.1%} error rate')
+    else:
+        print(f'capacity: {capacity["accounts_per_minute"]:.1f} purchased accounts/min in real latency, '
+              f'max roster in the {purchase_window_minutes} minutes window: {capacity["max_roster_size"]} accounts')
+
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump({'settings': vars(args), 'steps': steps, 'capacity': capacity}, report_file, indent=2)
@@ -0,0 +1,56 @@
+import argparse
+import logging
+import os
+import statistics
+import sys
+import time
+
+import CibusCassettes
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import CibusPurchaseEngine  # noqa: E402 - the purchase engine lives in the repository root
+
+
+def benchmark_replay(cassette, runs, latency_scale):
+    """
+    Runs the whole purchase flow repeatedly against a replayed cassette.
+
+    Args:
+        cassette (CibusCassettes.Cassette): The cassette to replay.
+        runs (int): The number of purchase flow runs.
+        latency_scale (float): The factor of the recorded latencies, 0 to replay without latency.
+
+    Returns:
+        list: The wall-clock duration of each run, in seconds.
+    """
+    CibusPurchaseEngine.connection_factory = CibusCassettes.replay_connection_factory(cassette, latency_scale)
+
+    durations = []
+    for _ in range(runs):
+        cassette.rewind()
+        start = time.perf_counter()
+        CibusPurchaseEngine.cibus_coupons_auto_purchase('', '')
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Cibus coupons purchase flow offline, by a cassette.')
+    parser.add_argument('cassette', nargs='?', help='the cassette file to replay',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cassettes', 'sample.json'))
+    parser.add_argument('--runs', type=int, default=20, help='the number of purchase flow runs')
+    parser.add_argument('--latency-scale', type=float, default=0.0,
+                        help='scale the recorded latencies (0 for no latency, 1 for the recorded latency)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    cassette = CibusCassettes.Cassette.load(args.cassette)
+    durations = benchmark_replay(cassette, args.runs, args.latency_scale)
+
+    recorded_latency = sum(interaction['latency'] for interaction in cassette.interactions)
+    print(f'cassette: {args.cassette}, {len(cassette.interactions)} interactions, '
+          f'{recorded_latency:.3f}s recorded latency')
+    print(f'runs: {args.runs}, latency scale: {args.latency_scale}')
+    print(f'min: {min(durations) * 1000:.2f}ms, median: {statistics.median(durations) * 1000:.2f}ms, '
+          f'mean: {statistics.mean(durations) * 1000:.2f}ms, max: {max(durations) * 1000:.2f}ms')
@@ -0,0 +1,264 @@
+import gzip
+import http.client
+import http.server
+import json
+import random
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+# The latency of each endpoint in seconds, as (mean, jitter), by latency profile
+latency_profiles = {
+    'none': {},
+    'fast': {
+        'auth': (0.02, 0.005),
+        'user_info': (0.015, 0.005),
+        'menu': (0.04, 0.01),
+        'order_times': (0.015, 0.005),
+        'add_to_cart': (0.02, 0.005),
+        'simulate_order': (0.02, 0.005),
+        'apply_order': (0.03, 0.01),
+    },
+    'typical': {
+        'auth': (0.4, 0.1),
+        'user_info': (0.2, 0.05),
+        'menu': (0.9, 0.2),
+        'order_times': (0.18, 0.05),
+        'add_to_cart': (0.25, 0.05),
+        'simulate_order': (0.3, 0.08),
+        'apply_order': (0.6, 0.15),
+    },
+    'evening_peak': {
+        'auth': (1.2, 0.4),
+        'user_info': (0.5, 0.15),
+        'menu': (2.5, 0.8),
+        'order_times': (0.4, 0.1),
+        'add_to_cart': (0.7, 0.2),
+        'simulate_order': (0.8, 0.2),
+        'apply_order': (1.8, 0.5),
+    },
+}
+
+default_coupons = {30: 1001, 50: 1002, 100: 1003, 200: 1004}
+
+
+class CibusStandIn:
+    """
+    A local stand-in of the Cibus API endpoints used by the purchase flow, with simulated per-endpoint latency
+    and failures. Every token has its own cart, emptied when its order is applied, and every user has a budget, spent
+    by the applied orders.
+    """
+
+    min_compressed_size = 256  # smaller responses are sent uncompressed, as gzip wouldn't make them smaller
+
+    def __init__(self, latency_profile='typical', latency_scale=1.0, error_rate=0.0, budget=150.0, coupons=None,
+                 seed=None, compression=False, menu_dishes=0, concurrent_cart_inserts='accept'):
+        """
+        Args:
+            latency_profile (str): The latency profile name, see latency_profiles.
+            latency_scale (float): The factor of the profile latencies.
+            error_rate (float): The probability of an endpoint to fail with HTTP 503.
+            budget (float): The budget of every user, before its applied orders.
+            coupons (dict): The coupon element IDs by coupon price, default_coupons by default.
+            seed (int): The seed of the latency and failure randomness.
+            compression (bool): Whether to gzip (or brotli, if installed) the responses of clients that accept it.
+            menu_dishes (int): The number of restaurant dishes in the menu tree besides the coupons, to make the menu
+                response as large as the real one.
+            concurrent_cart_inserts (str): How a cart insert is handled while another insert of the same token is in
+                flight - 'accept' it, 'reject' it (a server that doesn't support concurrent cart mutations), or
+                'lose' it (report success without adding it, a server with racy cart mutations).
+        """
+        self.latencies = latency_profiles[latency_profile]
+        self.latency_scale = latency_scale
+        self.error_rate = error_rate
+        self.budget = budget
+        self.coupons = coupons or default_coupons
+        self.compression = compression
+        self.menu_dishes = [self._create_dish(index) for index in range(menu_dishes)]
+        self.concurrent_cart_inserts = concurrent_cart_inserts
+        self.requests_count = 0
+        self.errors_count = 0
+        self.concurrent_cart_inserts_count = 0  # the concurrent cart inserts that were rejected or lost
+        self.bytes_sent = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._carts = {}
+        self._cart_inserts_in_flight = {}
+        self._token_users = {}
+        self._spent_budgets = {}
+        self._server = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self, ssl_context=None):
+        """
+        Starts serving on a free localhost port, in a background thread.
+
+        Args:
+            ssl_context (ssl.SSLContext): A server TLS context to serve over HTTPS, or None to serve over HTTP.
+        """
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # the headers and the body are written separately
+
+            def setup(self):
+                if ssl_context is not None:
+                    self.request.do_handshake()  # in the request thread, not to block the accepting thread
+                super().setup()
+
+            def do_GET(self):
+                stand_in._handle(self)
+
+            def do_POST(self):
+                stand_in._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        if ssl_context is not None:
+            self._server.socket = ssl_context.wrap_socket(self._server.socket, server_side=True,
+                                                          do_handshake_on_connect=False)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def connection_factory(self):
+        """
+        Creates a connection factory, for CibusPurchaseEngine.connection_factory, that connects every Cibus host
+        to the stand-in over HTTP.
+
+        Returns:
+            function: The connection factory.
+        """
+        return lambda host: http.client.HTTPConnection('127.0.0.1', self.port)
+
+    def _simulate(self, endpoint):
+        with self._lock:
+            self.requests_count += 1
+            mean, jitter = self.latencies.get(endpoint, (0, 0))
+            latency = max(0.0, self._random.gauss(mean, jitter)) * self.latency_scale
+            is_failed = self._random.random() < self.error_rate
+            self.errors_count += is_failed
+        time.sleep(latency)
+        return is_failed
+
+    @staticmethod
+    def _create_dish(index):
+        dish_random = random.Random(index)
+        words = ['סלט', 'עוף', 'בקר', 'טופו', 'אורז', 'ירקות', 'רוטב', 'חריף', 'לחם', 'גבינה', 'פטריות', 'בצל',
+                 'שום', 'לימון', 'טחינה', 'עגבניות', 'מלפפון', 'תפוחי אדמה', 'קינואה', 'אבוקדו']
+        return {'element_id': 2000 + index, 'name': ' '.join(dish_random.sample(words, 4)),
+                'description': ' '.join(dish_random.choices(words, k=18)), 'price': dish_random.randint(30, 90),
+                'image': f'https://images.cibus.example/dishes/{dish_random.getrandbits(64):016x}.jpg',
+                'is_available': dish_random.random() < 0.9,
+                'options': [{'id': dish_random.randint(1, 10 ** 6), 'name': ' '.join(dish_random.sample(words, 2)),
+                             'price': dish_random.choice([0, 3, 5, 8])} for _ in range(dish_random.randint(0, 5))]}
+
+    def _encode(self, handler, body):
+        if not self.compression or len(body) < self.min_compressed_size:
+            return body, None
+
+        accepted_encodings = {encoding.split(';')[0].strip()
+                              for encoding in handler.headers.get('Accept-Encoding', '').split(',')}
+        if 'br' in accepted_encodings:
+            try:
+                import brotli
+            except ImportError:
+                pass
+            else:
+                return brotli.compress(body, quality=5), 'br'  # a typical on-the-fly server quality
+        if 'gzip' in accepted_encodings:
+            return gzip.compress(body, compresslevel=6), 'gzip'
+        return body, None
+
+    def _respond(self, handler, status, data):
+        body, content_encoding = self._encode(handler, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json; charset=UTF-8')
+        if content_encoding:
+            handler.send_header('Content-Encoding', content_encoding)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+        with self._lock:
+            self.bytes_sent += len(body)
+
+    def _get_token(self, handler):
+        cookie = handler.headers.get('cookie', '')
+        return cookie[len('token='):] if cookie.startswith('token=') else None
+
+    def _handle(self, handler):
+        path = urlsplit(handler.path).path
+        body = handler.rfile.read(int(handler.headers.get('Content-Length') or 0))
+        payload = json.loads(body) if body else {}
+        token = self._get_token(handler)
+
+        if path == '/auth/authToken':
+            endpoint, response = 'auth', {'data': {'token': str(uuid.uuid4())}}
+        elif path == '/api/prx_user_info.py':
+            with self._lock:
+                budget = self.budget - self._spent_budgets.get(self._token_users.get(token), 0)
+            endpoint, response = 'user_info', {'user_cibus_id': abs(hash(token)) % 10 ** 6, 'budget': str(budget)}
+        elif path == '/api/rest_menu_tree.py':
+            endpoint, response = 'menu', {'12': [{'13': [{'price': price, 'element_id': element_id}
+                                                         for price, element_id in self.coupons.items()]},
+                                                 {'13': self.menu_dishes}]}
+        elif path == '/api/prx_order_times.py':
+            endpoint, response = 'order_times', {'timeinfo': {'ordtime': [{'time': '20:30'}]}}
+        elif path == '/api/main.py' and payload.get('type') == 'prx_add_prod_to_cart':
+            endpoint, response = 'add_to_cart', {'code': 0, 'msg': ''}
+        elif path == '/api/main.py' and payload.get('type') == 'prx_simulate_order':
+            with self._lock:
+                cart_count = len(self._carts.get(token, []))
+            endpoint, response = 'simulate_order', {'head': {'count': cart_count}}
+        elif path == '/api/main.py' and payload.get('type') == 'prx_apply_order':
+            endpoint, response = 'apply_order', {'head': {'count': 1}}
+        else:
+            self._respond(handler, 404, {'code': -1, 'msg': 'not found'})
+            return
+
+        if endpoint == 'add_to_cart':
+            with self._lock:
+                in_flight = self._cart_inserts_in_flight[token] = self._cart_inserts_in_flight.get(token, 0) + 1
+            try:
+                is_failed = self._simulate(endpoint)
+            finally:
+                with self._lock:
+                    self._cart_inserts_in_flight[token] -= 1
+            if not is_failed and self.concurrent_cart_inserts != 'accept' and in_flight > 1:
+                with self._lock:
+                    self.concurrent_cart_inserts_count += 1
+                if self.concurrent_cart_inserts == 'reject':
+                    self._respond(handler, 200, {'code': 1, 'msg': 'the cart is being updated'})
+                else:
+                    self._respond(handler, 200, response)
+                return
+        else:
+            is_failed = self._simulate(endpoint)
+
+        if is_failed:
+            self._respond(handler, 503, {'code': -1, 'msg': 'service unavailable'})
+            return
+
+        with self._lock:
+            if endpoint == 'auth':
+                self._token_users[response['data']['token']] = payload.get('username')
+            elif endpoint == 'add_to_cart':
+                self._carts.setdefault(token, []).append(payload['dish_list']['dish_price'])
+            elif endpoint == 'apply_order':
+                user_name = self._token_users.get(token)
+                spent_budget = self._spent_budgets.get(user_name, 0) + sum(self._carts.pop(token, []))
+                self._spent_budgets[user_name] = spent_budget
+        self._respond(handler, 200, response)
@@ -0,0 +1,149 @@
+import argparse
+import json
+import logging
+import os
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from CibusStandIn import CibusStandIn, latency_profiles
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import CibusPipeline  # noqa: E402 - the purchase engine lives in the repository root
+import CibusPurchaseEngine  # noqa: E402
+import CibusTransport  # noqa: E402
+
+
+def create_tls_contexts(cert_dir):
+    """
+    Creates a self-signed localhost certificate with the openssl CLI, and the TLS contexts of the stand-in and of
+    the clients that trust it.
+
+    Args:
+        cert_dir (str): The directory to write the certificate and its key to.
+
+    Returns:
+        tuple: The server and client ssl.SSLContext.
+    """
+    cert_path = os.path.join(cert_dir, 'cert.pem')
+    key_path = os.path.join(cert_dir, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=IP:127.0.0.1,DNS:localhost', '-keyout', key_path, '-out', cert_path],
+                   check=True, capture_output=True)
+
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(cert_path, key_path)
+    server_context.set_alpn_protocols(['http/1.1'])  # the stand-in is an http.server, HTTP/1.1 only
+
+    client_context = ssl.create_default_context(cafile=cert_path)
+    return server_context, client_context
+
+
+def get_unavailable_reason(transport):
+    """
+    Returns:
+        str: Why the transport can't run in this environment, or None if it can.
+    """
+    if transport != 'http2':
+        return None
+    try:
+        import h2  # noqa: F401
+        import httpx  # noqa: F401
+    except ImportError as error:
+        return f'{error.name} is not installed (pip install httpx[http2])'
+    return None
+
+
+def benchmark_transport(transport, args, server_context, client_context):
+    """
+    Runs single account purchase flows and then a roster through the pipeline against a TLS stand-in, over the
+    transport.
+
+    Args:
+        transport (str): The transport, see CibusTransport.transports.
+        args (argparse.Namespace): The benchmark arguments.
+        server_context (ssl.SSLContext): The stand-in TLS context.
+        client_context (ssl.SSLContext): The clients TLS context.
+
+    Returns:
+        dict: The latency of the single account flows, the roster duration and the bytes transferred per account.
+    """
+    stand_in = CibusStandIn(args.latency_profile, args.latency_scale, seed=0, compression=True,
+                            menu_dishes=args.menu_dishes)
+    stand_in.start(server_context)
+    CibusPurchaseEngine.connection_factory = lambda host: CibusTransport.create_connection(
+        '127.0.0.1', stand_in.port, client_context, transport)
+    CibusTransport.transfer_stats.reset()
+
+    try:
+        durations = []
+        for run in range(args.runs):
+            start = time.perf_counter()
+            CibusPurchaseEngine.cibus_coupons_auto_purchase(f'transport-benchmark-{run}', 'password')
+            durations.append(time.perf_counter() - start)
+
+        accounts = [(f'transport-benchmark-roster-{index}', 'password', CibusPurchaseEngine.default_solver_policy)
+                    for index in range(args.roster_size)]
+        start = time.perf_counter()
+        CibusPipeline.PurchasePipeline().run(accounts)
+        roster_duration = time.perf_counter() - start
+    finally:
+        CibusTransport.Http2Connection.close_clients()
+        stand_in.stop()
+
+    accounts_count = args.runs + args.roster_size
+    return {
+        'median_flow_ms': statistics.median(durations) * 1000,
+        'max_flow_ms': max(durations) * 1000,
+        'roster_seconds': roster_duration,
+        'wire_bytes_per_account': stand_in.bytes_sent / accounts_count,
+        'decoded_bytes_per_account': CibusTransport.transfer_stats.decoded_bytes / accounts_count or None,
+        'requests_per_account': stand_in.requests_count / accounts_count,
+        'http_versions': dict(CibusTransport.transfer_stats.http_versions),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the bytes transferred and the latency of the Cibus '
+                                                 'client transports, against a local TLS Cibus stand-in.')
+    parser.add_argument('--transports', nargs='+', choices=CibusTransport.transports,
+                        default=list(CibusTransport.transports), help='the transports to compare')
+    parser.add_argument('--runs', type=int, default=10, help='the number of single account purchase flows')
+    parser.add_argument('--roster-size', type=int, default=40, help='the roster size run through the pipeline')
+    parser.add_argument('--menu-dishes', type=int, default=150,
+                        help='the number of dishes in the stand-in menu, for a realistic menu response size')
+    parser.add_argument('--latency-profile', choices=sorted(latency_profiles), default='none',
+                        help='the stand-in latency profile')
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='scale the stand-in latencies')
+    parser.add_argument('--report', metavar='PATH', help='save the full report as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    report = {}
+    with tempfile.TemporaryDirectory() as cert_dir:
+        server_context, client_context = create_tls_contexts(cert_dir)
+        for transport in args.transports:
+            unavailable_reason = get_unavailable_reason(transport)
+            if unavailable_reason:
+                report[transport] = None
+                print(f'{transport:10s} skipped: {unavailable_reason}')
+                continue
+
+            result = report[transport] = benchmark_transport(transport, args, server_context, client_context)
+            print(f'{transport:10s} flow median: {result["median_flow_ms"]:7.1f}ms, '
+                  f'max: {result["max_flow_ms"]:7.1f}ms, roster of {args.roster_size}: '
+                  f'{result["roster_seconds"]:6.2f}s, received per account: '
+                  f'{result["wire_bytes_per_account"] / 1024:7.1f}KiB'
+                  + (f', negotiated: {result["http_versions"]}' if result['http_versions'] else ''))
+
+    if report.get('http2'):
+        print('note: the stand-in serves HTTP/1.1 only, so http2 negotiates HTTP/1.1 by ALPN and measures the pooled '
+              'compressed client, not the multiplexing')
+
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump({'settings': vars(args), 'transports': report}, report_file, indent=2)
@@ -0,0 +1,39 @@
+"""
+A stand-in of the azure.functions package, with the parts the triggers module uses at import time, for
+CibusImportTimeBenchmark.py to import and time the azure entry point where azure-functions isn't installed.
+"""
+import enum
+
+
+class AuthLevel(str, enum.Enum):
+    ANONYMOUS = 'anonymous'
+    FUNCTION = 'function'
+    ADMIN = 'admin'
+
+
+class TimerRequest:
+    pass
+
+
+class HttpRequest:
+    pass
+
+
+class HttpResponse:
+    def __init__(self, body=None, status_code=200, **kwargs):
+        self.body = body
+        self.status_code = status_code
+
+
+class FunctionApp:
+    def __init__(self, *args, **kwargs):
+        self.functions = []
+
+    def _register(self, *args, **kwargs):
+        def decorator(function):
+            self.functions.append(function)
+            return function
+        return decorator
+
+    timer_trigger = _register
+    route = _register